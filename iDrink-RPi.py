@@ -10,228 +10,2490 @@
 # Using GUIZERO library for UI
 # Using GPIOZERO for I/O
 
+import os
+import sys
+import argparse
+import asyncio
 import threading
 import time
 from time import sleep
+from collections import deque
 import json
-
-with open('Menu.json') as f:  # Read in the Menu JSON file
+import struct
+import mmap
+import heapq
+import itertools
+import signal
+import atexit
+import traceback
+import hmac
+from urllib.parse import parse_qs
+
+# Startup timing - how long each phase of getting the main screen up takes (printed once it is showing)
+STARTUP_T0 = time.perf_counter()
+startup_phases = []
+
+def startup_phase(name):
+    startup_phases.append((name, time.perf_counter()))
+
+def print_startup_times():
+    report = ''
+    last = STARTUP_T0
+    for name, t in startup_phases:
+        report += '  ' + name + ' ' + format((t - last) * 1000, '.0f') + ' ms'
+        last = t
+    print('Startup:' + report + '  total ' + format((time.perf_counter() - STARTUP_T0) * 1000, '.0f') + ' ms')
+
+# Events - the pour engine publishes pump, pour and queue changes as (kind, data) to every listener
+# Listeners are called on the publishing (pour) thread so must only hand the event off, never block
+event_listeners = []
+
+def subscribe_events(listener):
+    event_listeners.append(listener)
+
+def publish_event(kind, data):
+    for listener in event_listeners:
+        listener(kind, data)
+
+# Command line options (see README)
+parser = argparse.ArgumentParser(description='iDrink Automatic Bartender')
+parser.add_argument('--mock', action='store_true', help='use gpiozero mock pins instead of the real relays (or set IDRINK_BACKEND=mock)')
+parser.add_argument('--headless', action='store_true', help='run without a display, using a stub UI (or set IDRINK_HEADLESS=1)')
+parser.add_argument('--mix-report', action='store_true', help='print the pour mode simulation for every drink and quit')
+parser.add_argument('--relay-bench', action='store_true', help='benchmark relay write skew on mock pins and quit')
+parser.add_argument('--simulate', metavar='ORDERS', nargs='?', const='', help='replay drink orders (file of "seconds,drink name" lines, default every drink on the menu) on the mock backend and quit')
+parser.add_argument('--speed', type=float, default=1.0, help='simulation only - pour this many times faster than real time')
+parser.add_argument('--relay-log', metavar='CSV', help='simulation only - write every relay transition to this CSV file')
+parser.add_argument('--plan-layout', action='store_true', help='print the bottle moves from the loaded bottles to each menu, and the layout that covers the most drinks, then quit')
+parser.add_argument('--pour-log', metavar='FILE', help='log every pour to this file (default PourLog.bin next to Menu.json, simulations only log when this is given)')
+parser.add_argument('--stats', metavar='LOG', nargs='?', const='', help='print drinks per hour, wait and pour time percentiles, bottle use and pump duty cycle from the pour log and quit')
+parser.add_argument('--api', metavar='PORT', nargs='?', type=int, const=8080, default=os.environ.get('IDRINK_API_PORT'), help='serve the local HTTP/JSON order API on this port (default 8080, or set IDRINK_API_PORT)')
+parser.add_argument('--api-token', metavar='TOKEN', default=os.environ.get('IDRINK_API_TOKEN'), help='order API clients must send this token (Authorization: Bearer TOKEN, or ?token=TOKEN) - or set IDRINK_API_TOKEN')
+parser.add_argument('--api-origin', metavar='ORIGIN', default=os.environ.get('IDRINK_API_ORIGIN'), help='web page origin (e.g. http://tablet.local:8000) allowed to call the order API from a browser - or set IDRINK_API_ORIGIN')
+args = parser.parse_args()
+
+SIMULATING = args.simulate is not None
+SPEED = args.speed if SIMULATING else 1.0  #pour times are divided by this - --speed is ignored outside a simulation
+REPORT_ONLY = args.stats is not None or args.plan_layout  #print a report and quit - leave the relays and display to the running app
+MOCK_BACKEND = args.mock or args.relay_bench or args.mix_report or SIMULATING or REPORT_ONLY or os.environ.get('IDRINK_BACKEND', '') == 'mock'
+HEADLESS = args.headless or SIMULATING or REPORT_ONLY or os.environ.get('IDRINK_HEADLESS', '') == '1'
+
+# Pump I/O assignments - done first so the relays are held OFF as early as possible after a power up
+# Each pump has a forward and reverse relay (H circuit). A pour station is one bank of relays - the two pins of
+# pump 1 (F then R), then pump 2 and so on. Stations.json (next to this script) lists the stations when there is more
+# than one dispensing head; without it there is one station on RELAY_PINS
+#   {"Stations": [{"Name": "Left", "Pins": [2, 3, ...]}, {"Name": "Right", "Host": "pi2.local", "Pins": [2, 3, ...]}]}
+# Pins are anything gpiozero takes (BCM numbers, "GPIO5", "BOARD11"). The Pi's header has GPIO 0-27, so only one 8 pump
+# station fits on it - a station with a "Host" (and optional "Port") drives the pins of another Pi running pigpiod instead
+from gpiozero import LEDBoard, Device
+if MOCK_BACKEND:  #no real GPIO - use gpiozero's mock pins
+    from gpiozero.pins.mock import MockFactory
+    Device.pin_factory = MockFactory()
+APP_DIR = os.path.dirname(os.path.abspath(__file__))  #data files live next to this script (not wherever we were started from)
+STATIONS_FILE = os.path.join(APP_DIR, 'Stations.json')
+RELAY_PINS = (2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17) # RPi GPIO pins being used (single station)
+
+def load_stations():
+    try:
+        with open(STATIONS_FILE) as f:
+            config = json.load(f)['Stations']
+    except FileNotFoundError:
+        config = [{'Name': 'Main', 'Pins': list(RELAY_PINS)}]
+    return config
+
+# Pin factory of a station - None for the Pi's own pins, or a pigpio connection to the station's "Host"
+# (on the mock backend each host gets its own set of mock pins)
+def station_pin_factory(config):
+    if 'Host' not in config:
+        return None
+    if MOCK_BACKEND:
+        return MockFactory()
+    from gpiozero.pins.pigpio import PiGPIOFactory
+    return PiGPIOFactory(host=config['Host'], port=config.get('Port', 8888))
+
+# Relay bank - all relay writes go through set_pumps() which works out the station's full relay target state and applies
+# only the changed pins in one batch. Bit n of a station's relay_state is the level of its relay[n] (1 = high = relay off)
+RELAY_BREAK_TIME = 0.05     #seconds to let the relays open before a pump switches straight between FORWARD and REVERSE
+relay_log = None            #Simulation: list of (time, station index, old state, new state) for every relay write
+if SIMULATING:
+    relay_log = []
+
+# The pigpio connection of a relay board when it has one - lets us set all its pins with one bank write
+# (only for BCM pin numbers, the bank masks are by GPIO number). Asked of the board itself: gpiozero picks the
+# pin factory when the first device is made, so Device.pin_factory is still None before that
+def relay_gpio_bank(board, pins):
+    try:
+        from gpiozero.pins.pigpio import PiGPIOFactory
+    except ImportError:
+        return None
+    if isinstance(board.pin_factory, PiGPIOFactory) and all(isinstance(pin, int) for pin in pins):
+        return board.pin_factory.connection
+    return None
+
+# Pour stations - each has its own relays, bottles, pour queue and dispatcher thread
+# A station is a dict of:
+#   index, name, pins
+#   relay, relay_pins, relay_state, relay_lock, all_off, gpio_bank - the relay bank (gpio_bank None unless pigpio on BCM numbers)
+#   queue - drink orders waiting: (menu index, drink name, time queued, tweaked recipe in this station's pump order or None)
+#   pour_active, pouring_drink, pour_ends (monotonic time the pour will finish) - guarded by pour_queue_cv
+#   pour_cancel - Event set by ALL OFF to stop the drink being poured
+#   maintenance_program, maintenance_running, maintenance_cancel - see the maintenance programs
+#   calibration_pump - the pump of the calibration run waiting or running (see the calibration run)
+#   pumps_ON, pour_overshoot - per pump, for the last pour
+#   watchdog - per pump, the watchdog's arm while the pump is on (see the watchdog)
+#   bottles, pours - the loaded bottles and the drinks they can pour (see compile_pours)
+stations = []
+for config in load_stations():
+    pins = tuple(config['Pins'])
+    board = LEDBoard (*pins, initial_value=True, pin_factory=station_pin_factory(config))  #pins start high - relays OFF (active low), never pulsed on at startup
+    board.on()  #turn off all the relays at startup (active low)
+    stations.append({'index': len(stations), 'name': config.get('Name', 'Station ' + str(len(stations) + 1)), 'pins': pins,
+                     'relay': board, 'relay_pins': [led.pin for led in board],  #write the pins directly, skipping the per-LED overhead
+                     'relay_state': (1 << len(pins)) - 1, 'relay_lock': threading.RLock(), 'all_off': (1 << len(pins)) - 1,
+                     'gpio_bank': relay_gpio_bank(board, pins),
+                     'queue': deque(), 'pour_active': False, 'pouring_drink': None, 'pour_ends': 0, 'pour_cancel': threading.Event(),
+                     'maintenance_program': None, 'maintenance_running': None, 'maintenance_cancel': threading.Event(), 'calibration_pump': 0,
+                     'pumps_ON': [], 'pour_overshoot': [], 'watchdog': [], 'bottles': [], 'pours': []})
+station_by_name = {station['name']: station for station in stations}
+
+startup_phase('GPIO (relays off)')
+
+MENU_FILE = os.path.join(APP_DIR, 'Menu.json')
+
+with open(MENU_FILE) as f:  # Read in the Menu JSON file
   menu_json = json.load(f)
 
-from guizero import App, Window, Text, TextBox, Box, PushButton, ListBox
+# Number of pumps per station (and so the length of every Bottles and Recipe array) - the menu collection's BottleCount
+PUMP_COUNT = menu_json.get('BottleCount', 8)
+for station in stations:
+    if len(station['pins']) != PUMP_COUNT * 2:
+        print('Station "' + station['name'] + '" has ' + str(len(station['pins'])) + ' relay pins, expected ' + str(PUMP_COUNT * 2) + ' for ' + str(PUMP_COUNT) + ' pumps (BottleCount)')
+        sys.exit(1)
+    station['pumps_ON'] = [0] * PUMP_COUNT          #Keep track of which pumps are on during a recipe pour
+    station['pour_overshoot'] = [0.0] * PUMP_COUNT  #How late (ms) each pump was turned off in the last pour
+    station['watchdog'] = [None] * PUMP_COUNT
+
+if HEADLESS:
+    # Stand-in for every guizero widget when there is no display. Widgets keep their value/items so the
+    # pour code can run unchanged, and the App runs after()/repeat() callbacks in display() like Tk would
+    class HeadlessWidget:
+        def __init__(self, master=None, *args, **kwargs):
+            self.value = kwargs.get('text', '')
+            if 'options' in kwargs:  #Combo
+                self.value = kwargs.get('selected') or kwargs['options'][0]
+            self.items = list(kwargs.get('items') or [])
+            self.enabled = True
+            self._timers = []
+            self._running = False
+        def __getattr__(self, name):  #show(), hide(), focus(), set_full_screen() etc - nothing to do
+            return lambda *args, **kwargs: None
+        def append(self, value):
+            self.value = str(self.value) + str(value)
+        def clear(self):
+            self.value = ''
+            self.items = []
+        def insert(self, index, value):
+            self.items.insert(index, value)
+        def enable(self):
+            self.enabled = True
+        def disable(self):
+            self.enabled = False
+        def after(self, time_ms, function, args=[]):
+            self._timers.append([time.monotonic() + time_ms / 1000, 0, function, args])
+        def repeat(self, time_ms, function, args=[]):
+            self._timers.append([time.monotonic() + time_ms / 1000, time_ms, function, args])
+        def cancel(self, function):
+            self._timers = [t for t in self._timers if t[2] != function]
+        def display(self):
+            self._running = True
+            while self._running:
+                now = time.monotonic()
+                for t in list(self._timers):
+                    if t[0] <= now:
+                        if t[1] == 0:
+                            self._timers.remove(t)
+                        else:
+                            t[0] = now + t[1] / 1000
+                        t[2](*t[3])
+                sleep(0.01)
+        def destroy(self):
+            self._running = False
+    App = Window = Text = TextBox = Box = PushButton = ListBox = Combo = Drawing = Slider = HeadlessWidget
+else:
+    from guizero import App, Window, Text, TextBox, Box, PushButton, ListBox, Combo, Drawing, Slider
+startup_phase('UI import')
 
 menu_index = 0 #keep count of which menue is being displayed as user scrolls through them in the Menu screen
 chosen_menu_index = 0 # the active menu chosen by the user (default is 0 of course)
-pumps_ON = [0,0,0,0,0,0,0,0] #Keep track of which pumps are on during a recipe pour
 DRINK_SIZE_FACTOR = 1.0     #Scale the drink up or down in size. 1 = actual specified ounce units
 PUMP_POUR_RATE = 286        #How many milliseconds for a pump to pour 1/10th of an ounce of liquid
 touchscreen_debounce = 0   #for debouncing the drink our tap
+TOUCHSCREEN_DEBOUNCE = 1.0  #seconds - a second tap on the same drink within this time is a duplicate
+POUR_QUEUE_SIZE = 6         #Max number of drink orders waiting to be poured at each station
+pour_queue_cv = threading.Condition()  #Guards the station queues and wakes up the pour dispatchers
+last_queued_drink = ''      #Last drink tapped (for rejecting duplicate taps)
+POUR_REPORT = True          #Print the per-pump shut-off overshoot after each pour
+sim_pours = []              #Simulation: stats of every finished pour
+sim_rejected = []           #Simulation: orders the pour queue turned away
+POUR_MODE = 'ALL_ON'        #'ALL_ON' = run every ingredient pump at once, 'MIX' = time-slice the pumps to mix while pouring
+MAX_PUMPS_ON = 3            #MIX mode: most pumps allowed on at once (power supply / relay current limit)
+MIX_SLICE_MS = 500          #MIX mode: how long a pump runs before the mixer may switch to another one
+
+# Compile the Menu JSON into the in-memory menu model used for pouring and drawing the screens
+# Done once at load time so bad recipes fail here rather than half-way through a pour
+# Each compiled menu is a dict of:
+#   MenuName - as in the JSON
+#   Bottles - as in the JSON (the recipe column order)
+#   DrinkNames - drink names in menu order
+#   Recipes - drink name -> recipe (1/10th oz per pump)
+#   Durations - drink name -> tuple of per-pump pour times in milliseconds (first station's pumps, in the JSON order)
+# What each station actually pours is in its pour table (see compile_pours)
+def compile_menus(menu_collection):
+    if not isinstance(menu_collection, dict) or not isinstance(menu_collection.get('Menu'), list):
+        raise ValueError('expected an object with a "Menu" list')
+    if menu_collection.get('BottleCount', PUMP_COUNT) != PUMP_COUNT:  #the relay pins are set up for PUMP_COUNT pumps
+        raise ValueError('BottleCount changed to ' + str(menu_collection['BottleCount']) + ' - restart iDrink to use it')
+    compiled = []
+    for m in menu_collection['Menu']:
+        menu_name = m['MenuName']
+        if len(m['Bottles']) != PUMP_COUNT:
+            raise ValueError('Menu "' + menu_name + '" has ' + str(len(m['Bottles'])) + ' bottles, expected ' + str(PUMP_COUNT))
+        drink_names = []
+        recipes = {}
+        durations = {}
+        for d in m['Drink']:
+            name = d['Name']
+            recipe = d['Recipe']
+            if name in recipes:
+                raise ValueError('Menu "' + menu_name + '" has more than one drink named "' + name + '"')
+            if len(recipe) != PUMP_COUNT:
+                raise ValueError('Drink "' + name + '" in menu "' + menu_name + '" has ' + str(len(recipe)) + ' recipe entries, expected ' + str(PUMP_COUNT))
+            for amount in recipe:
+                if not isinstance(amount, (int, float)) or amount < 0:
+                    raise ValueError('Drink "' + name + '" in menu "' + menu_name + '" has an invalid recipe amount: ' + repr(amount))
+            drink_names.append(name)
+            recipes[name] = recipe
+            durations[name] = recipe_durations(stations[0], recipe, m['Bottles'])
+        compiled.append({'MenuName': menu_name, 'Bottles': m['Bottles'], 'DrinkNames': drink_names, 'Recipes': recipes, 'Durations': durations})
+    return compiled
+
+# A station's pour table - for each menu, the drinks whose bottles are all loaded on the station (in any pump order):
+#   drink name -> (recipe moved to the pumps its bottles are on, per-pump pour times in ms, pour time in ms)
+# Returns (the loaded bottles, the table)
+def compile_pours(station, menu_list):
+    layout = loaded_layout(station)
+    pours = []
+    for m in menu_list:
+        drinks = {}
+        for name in m['DrinkNames']:
+            recipe = remap_recipe(m['Recipes'][name], m['Bottles'], layout)
+            if recipe is not None:
+                durations = recipe_durations(station, recipe, layout)
+                drinks[name] = (recipe, durations, schedule_ms(pour_schedule(durations)))
+        pours.append(drinks)
+    return layout, pours
+
+# Compile the pour table of every station (after a calibration or bottle layout change)
+def compile_all_pours():
+    for station in stations:
+        station['bottles'], station['pours'] = compile_pours(station, menus)
+
+# Move a recipe's columns from the menu's bottle order to the pumps those bottles are loaded on (None if one isn't loaded)
+def remap_recipe(recipe, bottles, layout):
+    remapped = [0] * PUMP_COUNT
+    for x in range(PUMP_COUNT):
+        if recipe[x] > 0:
+            if bottles[x] not in layout:
+                return None
+            remapped[layout.index(bottles[x])] += recipe[x]
+    return remapped
+
+# Per-pump pour times (whole milliseconds) for a recipe, using the calibrated rate of each of the station's pumps / bottles
+def recipe_durations(station, recipe, bottles):
+    durations = []
+    for x in range(PUMP_COUNT):
+        if recipe[x] == 0:
+            durations.append(0)
+        else:
+            rate, prime = pump_calibration(station, x+1, bottles[x])
+            durations.append(int(round(((recipe[x] * rate * DRINK_SIZE_FACTOR) + prime) / SPEED)))
+    return tuple(durations)
+
+# Pump calibration table (Calibration.json) - replaces the single PUMP_POUR_RATE for pumps / bottles that have been measured
+#   {"Pumps": {"1": {"Rate": 280, "Prime": 150}, "Right:1": {"Rate": 290}, ...}, "Bottles": {"Orange": {"Rate": 330}, ...}}
+# Rate is milliseconds to pour 1/10th of an ounce, Prime is extra milliseconds added to every pour (dead volume in the line)
+# Pumps of the first station are keyed by number, those of the other stations by "station name:number"
+# A Bottles entry (e.g. for thick juices) wins over the Pumps entry of the pump it is loaded on
+CALIBRATION_FILE = os.path.join(APP_DIR, 'Calibration.json')
+CALIBRATION_RUN_MS = 10000  #How long the Control Panel calibration run keeps a pump on
+
+def load_calibration():
+    try:
+        with open(CALIBRATION_FILE) as f:
+            table = json.load(f)
+    except FileNotFoundError:
+        table = {}
+    table.setdefault('Pumps', {})
+    table.setdefault('Bottles', {})
+    return table
+
+# Write the calibration table atomically (a power cut mid-write leaves the old file in place)
+def save_calibration():
+    with open(CALIBRATION_FILE + '.tmp', 'w') as f:
+        json.dump(calibration, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(CALIBRATION_FILE + '.tmp', CALIBRATION_FILE)
+
+# Calibration.json key of a station's pump
+def pump_key(station, pump_num):
+    if station['index'] == 0:
+        return str(pump_num)
+    return station['name'] + ':' + str(pump_num)
+
+# Pour rate (ms per 1/10th oz) and prime offset (ms) for a station's pump (1-PUMP_COUNT) with the given bottle loaded
+def pump_calibration(station, pump_num, bottle):
+    entry = calibration['Bottles'].get(bottle)
+    if entry is None:
+        entry = calibration['Pumps'].get(pump_key(station, pump_num), {})
+    return entry.get('Rate', PUMP_POUR_RATE), entry.get('Prime', 0)
+
+calibration = load_calibration()
+
+# Bottle inventory (Inventory.json) - ounces left in each bottle, by bottle name, and the bottle on each pump of each station
+#   {"Bottles": {"Vodka": {"Level": 12.5, "Capacity": 25.4}, "Right/Vodka": {...}, ...}, "Loaded": {"Main": ["Vodka", "Tequilla", ...]}}
+# The bottles of the first station are keyed by name, those of the other stations by "station name/bottle name"
+# Bottles not in the file are taken to be full, and a station with no "Loaded" list has the first menu's bottles on its pumps. Each pour subtracts what it poured, and the file is
+# written by a background thread so the pour thread never waits on the SD card
+INVENTORY_FILE = os.path.join(APP_DIR, 'Inventory.json')
+BOTTLE_CAPACITY_OZ = 25.4   #Default bottle size (750ml)
+LOW_LEVEL_OZ = 4.0          #Warn when a bottle gets below this...
+LOW_LEVEL_MINUTES = 20      #...or is expected to run out within this many minutes at the recent pour rate
+POUR_RATE_WINDOW = 3600     #seconds of pour history used for the time-to-empty estimate
+inventory_lock = threading.Lock()
+inventory_dirty = threading.Event()  #wakes up the inventory writer
+bottle_usage = {}           #bottle name -> deque of (time, ounces) poured within the last POUR_RATE_WINDOW
+
+def load_inventory():
+    try:
+        with open(INVENTORY_FILE) as f:
+            table = json.load(f)
+    except FileNotFoundError:
+        table = {}
+    table.setdefault('Bottles', {})
+    return table
+
+# Inventory key of a bottle at a station
+def bottle_key(station, bottle):
+    if station['index'] == 0:
+        return bottle
+    return station['name'] + '/' + bottle
+
+# Inventory entry for a bottle (added as a full bottle the first time it is seen). Caller holds inventory_lock
+def bottle_entry(station, bottle):
+    entry = inventory['Bottles'].get(bottle_key(station, bottle))
+    if entry is None:
+        entry = {'Level': BOTTLE_CAPACITY_OZ, 'Capacity': BOTTLE_CAPACITY_OZ}
+        inventory['Bottles'][bottle_key(station, bottle)] = entry
+    return entry
+
+# The bottle on each pump of a station ('' for none)
+def loaded_layout(station):
+    with inventory_lock:
+        return list(inventory['Loaded'][station['name']])
+
+def set_loaded_layout(station, layout):
+    with inventory_lock:
+        inventory['Loaded'][station['name']] = list(layout)
+    inventory_dirty.set()
+
+def bottle_level(station, bottle):
+    with inventory_lock:
+        return bottle_entry(station, bottle)['Level']
+
+# Take the ounces poured from each of a station's bottles (called from the pour thread - memory only, the writer saves it)
+def use_bottles(station, bottles, ounces):
+    now = time.monotonic()
+    with inventory_lock:
+        for x in range(PUMP_COUNT):
+            if ounces[x] > 0:
+                entry = bottle_entry(station, bottles[x])
+                entry['Level'] = max(0.0, round(entry['Level'] - ounces[x], 2))
+                usage = bottle_usage.setdefault(bottle_key(station, bottles[x]), deque())
+                usage.append((now, ounces[x]))
+                while usage[0][0] < now - POUR_RATE_WINDOW:
+                    usage.popleft()
+    inventory_dirty.set()
+
+# Refill a station's bottle to its capacity
+def refill_bottle(station, bottle):
+    with inventory_lock:
+        entry = bottle_entry(station, bottle)
+        entry['Level'] = entry['Capacity']
+        bottle_usage.pop(bottle_key(station, bottle), None)
+    inventory_dirty.set()
+
+# Estimated minutes until a station's bottle runs dry at its recent pour rate (None if it hasn't been used lately)
+def bottle_minutes_left(station, bottle):
+    now = time.monotonic()
+    with inventory_lock:
+        usage = bottle_usage.get(bottle_key(station, bottle))
+        if not usage:
+            return None
+        poured = sum(oz for t, oz in usage if t >= now - POUR_RATE_WINDOW)
+        if poured == 0:
+            return None
+        span = max(now - usage[0][0], 600)  #at least 10 minutes so one pour doesn't look like a huge rate
+        return bottle_entry(station, bottle)['Level'] / (poured / span) / 60
+
+# Inventory writer thread - saves the inventory whenever it changes (several pours are saved in one write)
+def inventory_writer():
+    while True:
+        inventory_dirty.wait()
+        sleep(1)  #let a burst of changes collect into one write
+        save_inventory()
+
+# Write the inventory atomically (a power cut mid-write leaves the old file in place)
+def save_inventory():
+    inventory_dirty.clear()
+    with inventory_lock:
+        data = json.dumps(inventory, indent=2)
+    with open(INVENTORY_FILE + '.tmp', 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(INVENTORY_FILE + '.tmp', INVENTORY_FILE)
+
+inventory = load_inventory()
+loaded = inventory.get('Loaded')
+if isinstance(loaded, list):  #a single station inventory from before Stations.json
+    loaded = {stations[0]['name']: loaded}
+elif not isinstance(loaded, dict):
+    loaded = {}
+for station in stations:
+    if len(loaded.get(station['name'], [])) != PUMP_COUNT:
+        loaded[station['name']] = list(menu_json['Menu'][0]['Bottles'])
+inventory['Loaded'] = loaded
+
+# Pour log (PourLog.bin) - every pour appended as one fixed-width binary record, read back by --stats
+# A 16 byte header (magic, version, pump count, record size) and then the records back to back:
+#   start time (epoch s), queue wait (ms), pour time (ms), menu, drink, flags (station index in the high byte),
+#   then per pump: bottle, commanded on-time (ms), actual on-time (ms), ounces (1/100th oz)
+# Menu, drink and bottle names are stored as numbers - the names are in PourLog.names, one per line (line n
+# is name n) - which keeps a record to 118 bytes with 8 pumps. The pour thread only adds the pour to a list, the writer
+# thread packs the pours that came in over POUR_LOG_FLUSH seconds and writes them in one go (SD card wear)
+POUR_LOG_FILE = os.path.join(APP_DIR, 'PourLog.bin')
+POUR_LOG_MAGIC = b'IDPL'
+POUR_LOG_VERSION = 1
+POUR_LOG_HEADER = struct.Struct('<4sHHH6x')
+POUR_LOG_FLUSH = 10         #seconds
+POUR_LOG_TWEAKED = 1        #flags bit: poured from a tweaked recipe
+POUR_LOG_CANCELLED = 2      #flags bit: stopped part way by ALL OFF (the ounces are what was poured)
+POUR_LOG_STATION_SHIFT = 8  #flags bits 8-15: index of the station that poured it
+pour_log_lock = threading.Lock()
+pour_log_dirty = threading.Event()  #wakes up the pour log writer
+pour_log_file_lock = threading.Lock()
+pour_log_pending = []       #pour stats waiting to be written
+pour_log_name_ids = None    #name -> number, loaded from the names file on the first write
+pour_log_path = args.pour_log or POUR_LOG_FILE
+if SIMULATING and not args.pour_log:  #a simulation leaves the real pour log alone
+    pour_log_path = None
+
+# The record layout for a log with pump_count pumps
+def pour_log_struct(pump_count):
+    p = str(pump_count)
+    return struct.Struct('<dffHHH' + p + 'H' + p + 'I' + p + 'f' + p + 'H')
+
+def pour_log_names_file(path):
+    return os.path.splitext(path)[0] + '.names'
+
+def load_pour_log_names(path):
+    try:
+        with open(pour_log_names_file(path), encoding='utf-8') as f:
+            return f.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+# Called by the pour thread with the stats of every finished pour - memory only, the writer saves it
+def log_pour(stats):
+    with pour_log_lock:
+        pour_log_pending.append(stats)
+    pour_log_dirty.set()
+
+# Pour log writer thread
+def pour_log_writer(path):
+    while True:
+        pour_log_dirty.wait()
+        sleep(POUR_LOG_FLUSH)  #let the pours of the next few seconds go in the same write
+        flush_pour_log(path)
+
+# Append the pours waiting in memory to the log (new names go to the names file first)
+def flush_pour_log(path):
+    global pour_log_name_ids
+    with pour_log_file_lock:  #the writer thread and the final flush at exit can both get here
+        pour_log_dirty.clear()
+        with pour_log_lock:
+            pours = pour_log_pending[:]
+            del pour_log_pending[:]
+        if len(pours) == 0:
+            return
+
+        if pour_log_name_ids is None:
+            pour_log_name_ids = {}
+            for name in load_pour_log_names(path):
+                pour_log_name_ids.setdefault(name, len(pour_log_name_ids))
+            open_pour_log(path)
+        new_names = []
+        def name_id(name):
+            name = name.replace('\n', ' ')
+            if name not in pour_log_name_ids:
+                pour_log_name_ids[name] = len(pour_log_name_ids)
+                new_names.append(name)
+            return pour_log_name_ids[name]
+
+        record = pour_log_struct(PUMP_COUNT)
+        data = bytearray()
+        for stats in pours:
+            flags = stats['station'] << POUR_LOG_STATION_SHIFT
+            if stats['tweaked']:
+                flags |= POUR_LOG_TWEAKED
+            if stats['cancelled']:
+                flags |= POUR_LOG_CANCELLED
+            data += record.pack(stats['started'], stats['wait'] * 1000, stats['time'] * 1000, name_id(stats['menu']), name_id(stats['drink']), flags,
+                                *([name_id(bottle) for bottle in stats['bottles']] + list(stats['durations']) + list(stats['on_ms']) +
+                                  [int(round(oz * 100)) for oz in stats['ounces']]))
+
+        if len(new_names) > 0:
+            with open(pour_log_names_file(path), 'a', encoding='utf-8') as f:
+                f.write(''.join(name + '\n' for name in new_names))
+                f.flush()
+                os.fsync(f.fileno())
+        with open(path, 'ab') as f:
+            if f.tell() == 0:
+                f.write(POUR_LOG_HEADER.pack(POUR_LOG_MAGIC, POUR_LOG_VERSION, PUMP_COUNT, record.size))
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+# Check the log before the first append: a log from a different pump count / version is moved aside,
+# and a record cut short by a power cut is dropped so the next one starts in the right place
+def open_pour_log(path):
+    try:
+        with open(path, 'r+b') as f:
+            size = os.fstat(f.fileno()).st_size
+            header = f.read(POUR_LOG_HEADER.size)
+            record_size = pour_log_struct(PUMP_COUNT).size
+            if len(header) < POUR_LOG_HEADER.size or POUR_LOG_HEADER.unpack(header) != (POUR_LOG_MAGIC, POUR_LOG_VERSION, PUMP_COUNT, record_size):
+                size = None
+            elif (size - POUR_LOG_HEADER.size) % record_size != 0:
+                f.truncate(size - (size - POUR_LOG_HEADER.size) % record_size)
+    except FileNotFoundError:
+        return
+    if size is None:
+        print('Pour log ' + path + ' is not in this format - moved to ' + path + '.old')
+        os.replace(path, path + '.old')
+
+# Percentiles (linear between the closest ranks, like numpy) of a sorted list
+def percentiles(values, ps):
+    result = []
+    for p in ps:
+        at = (len(values) - 1) * p / 100
+        low = int(at)
+        high = min(low + 1, len(values) - 1)
+        result.append(values[low] + (values[high] - values[low]) * (at - low))
+    return result
+
+# Work out the --stats figures from the log's columns with numpy (whole columns at a time, fast for a season of pours)
+def pour_stats_numpy(np, log, count, pump_count):
+    p = (pump_count,)
+    pours = np.frombuffer(log, count=count, offset=POUR_LOG_HEADER.size, dtype=np.dtype([
+        ('time', '<f8'), ('wait', '<f4'), ('pour', '<f4'), ('menu', '<u2'), ('drink', '<u2'), ('flags', '<u2'),
+        ('bottle', '<u2', p), ('commanded', '<u4', p), ('actual', '<f4', p), ('ounces', '<u2', p)]))
+    hours = np.unique((pours['time'] // 3600).astype(np.int64), return_counts=True)[1]
+    finished = (pours['flags'] & POUR_LOG_CANCELLED) == 0  #a pour stopped by ALL OFF says nothing about pour times or pump timing
+    used = (pours['commanded'] > 0) & finished[:, np.newaxis]
+    error = pours['actual'][used] - pours['commanded'][used]
+    pour_times = pours['pour'][finished]
+    bottle_oz = np.bincount(pours['bottle'].ravel(), weights=pours['ounces'].ravel()) / 100
+    station = pours['flags'] >> POUR_LOG_STATION_SHIFT
+    return {'per_hour': (float(hours.mean()), int(hours.max())), 'tweaked': int(np.count_nonzero(pours['flags'] & POUR_LOG_TWEAKED)),
+            'cancelled': int(count - np.count_nonzero(finished)), 'wait': np.percentile(pours['wait'], [50, 90, 99, 100]).tolist(),
+            'pour': np.percentile(pour_times, [50, 90, 99, 100]).tolist() if len(pour_times) > 0 else None,
+            'error': np.percentile(error, [50, 90, 99, 100]).tolist() if len(error) > 0 else None,
+            'bottle_oz': dict(enumerate(bottle_oz.tolist())),
+            'pump_on_ms': {int(s): pours['actual'][station == s].sum(axis=0, dtype=np.float64).tolist() for s in np.unique(station)}}
+
+# The same figures without numpy, one record at a time
+def pour_stats_python(log, count, pump_count):
+    record = pour_log_struct(pump_count)
+    hours = {}
+    tweaked = 0
+    cancelled = 0
+    waits = []
+    pour_times = []
+    errors = []
+    bottle_oz = {}
+    pump_on_ms = {}
+    rows = struct.iter_unpack(record.format, memoryview(log)[POUR_LOG_HEADER.size:POUR_LOG_HEADER.size + count * record.size])
+    for row in rows:
+        hour = int(row[0] // 3600)
+        hours[hour] = hours.get(hour, 0) + 1
+        if row[5] & POUR_LOG_TWEAKED:
+            tweaked += 1
+        finished = not row[5] & POUR_LOG_CANCELLED
+        if not finished:
+            cancelled += 1
+        waits.append(row[1])
+        if finished:
+            pour_times.append(row[2])
+        on_ms = pump_on_ms.setdefault(row[5] >> POUR_LOG_STATION_SHIFT, [0.0] * pump_count)
+        for x in range(pump_count):
+            bottle, commanded, actual, ounces = row[6 + x], row[6 + pump_count + x], row[6 + 2 * pump_count + x], row[6 + 3 * pump_count + x]
+            if commanded > 0 and finished:
+                errors.append(actual - commanded)
+            bottle_oz[bottle] = bottle_oz.get(bottle, 0) + ounces / 100
+            on_ms[x] += actual
+    waits.sort()
+    pour_times.sort()
+    errors.sort()
+    return {'per_hour': (count / len(hours), max(hours.values())), 'tweaked': tweaked, 'cancelled': cancelled,
+            'wait': percentiles(waits, [50, 90, 99, 100]), 'pour': percentiles(pour_times, [50, 90, 99, 100]) if len(pour_times) > 0 else None,
+            'error': percentiles(errors, [50, 90, 99, 100]) if len(errors) > 0 else None,
+            'bottle_oz': bottle_oz, 'pump_on_ms': pump_on_ms}
+
+# --stats: read the pour log (memory mapped, so only the pages used are read in) and print the report
+def print_pour_stats(path):
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        print('No pour log at ' + path)
+        return
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= POUR_LOG_HEADER.size:
+            print('No pours logged in ' + path)
+            return
+        log = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, pump_count, record_size = POUR_LOG_HEADER.unpack_from(log)
+    if magic != POUR_LOG_MAGIC or version != POUR_LOG_VERSION or record_size != pour_log_struct(pump_count).size:
+        print(path + ' is not an iDrink pour log (or is from a newer version)')
+        return
+    count = (size - POUR_LOG_HEADER.size) // record_size
+    if count == 0:
+        print('No pours logged in ' + path)
+        return
 
-# Pump I/O assignments
-# 8 pumps, each with a forward and reverse relay (H circuit) - 16 pins total
-# First two numbers are F and R relay GPIO pins for first pump. And so on.
-from gpiozero import LEDBoard
-relay = LEDBoard (2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17) # RPi GPIO pins being used
-relay.on()  #turn off all the relays at startup (active low)
+    try:
+        import numpy
+        stats = pour_stats_numpy(numpy, log, count, pump_count)
+    except ImportError:
+        stats = pour_stats_python(log, count, pump_count)
+    first = struct.unpack_from('<d', log, POUR_LOG_HEADER.size)[0]
+    last_start, last_wait, last_pour = struct.unpack_from('<dff', log, POUR_LOG_HEADER.size + (count - 1) * record_size)
+    span_ms = max((last_start - first) * 1000 + last_pour, 1)
+    names = load_pour_log_names(path)
+    def name(n):
+        return names[n] if n < len(names) else '#' + str(n)
+
+    print('Pour log ' + path + ': ' + str(count) + ' pours (' + str(stats['tweaked']) + ' tweaked, ' + str(stats['cancelled']) + ' cancelled) from ' +
+          time.strftime('%Y-%m-%d %H:%M', time.localtime(first)) + ' to ' + time.strftime('%Y-%m-%d %H:%M', time.localtime(last_start)))
+    print('Drinks per hour: ' + format(stats['per_hour'][0], '.1f') + ' average (hours with pours), ' + str(stats['per_hour'][1]) + ' busiest hour')
+    for label, key in (('Queue wait (s)', 'wait'), ('Pour time (s)', 'pour')):
+        if stats[key] is None:  #every pour was cancelled
+            continue
+        p50, p90, p99, top = stats[key]
+        print(format(label, '<24') + 'p50 ' + format(p50 / 1000, '.2f') + '   p90 ' + format(p90 / 1000, '.2f') + '   p99 ' + format(p99 / 1000, '.2f') + '   max ' + format(top / 1000, '.2f'))
+    if stats['error'] is not None:
+        p50, p90, p99, top = stats['error']
+        print(format('Pump on-time error (ms)', '<24') + 'p50 ' + format(p50, '.2f') + '   p90 ' + format(p90, '.2f') + '   p99 ' + format(p99, '.2f') + '   max ' + format(top, '.2f'))
+    print('Bottle use (oz):')
+    for bottle, oz in sorted(stats['bottle_oz'].items(), key=lambda item: -item[1]):
+        if oz > 0:
+            print('  ' + format(name(bottle), '<20') + format(oz, '8.1f'))
+    for station_index, on_ms in sorted(stats['pump_on_ms'].items()):
+        report = ''
+        for x in range(pump_count):
+            report += ' P' + str(x+1) + '=' + format(on_ms[x] * 100 / span_ms, '.1f')
+        if len(stats['pump_on_ms']) > 1:  #a log from more than one station
+            label = 'Station ' + str(station_index + 1)
+            if station_index < len(stations):
+                label = stations[station_index]['name']
+            print(label + ' pump duty cycle (%):' + report)
+        else:
+            print('Pump duty cycle (%):' + report)
+
+if args.stats is not None:  #print the pour log report and quit
+    print_pour_stats(args.stats or POUR_LOG_FILE)
+    sys.exit()
+
+# Build the pour schedule from per-pump pour times: a list of (time in ms, pump index, 'FORWARD' or 'OFF') sorted by time
+# At most max_on pumps run at once. The pumps with the most pour time left always get the run slots, which
+# interleaves them so the pour takes as close to max(longest ingredient, total / max_on) as possible.
+# slice_ms is how long a pump keeps its slot before the others are looked at again (0 = run to completion)
+#   max_on = PUMP_COUNT, slice_ms = 0 -> all ingredient pumps on together (ALL_ON)
+#   max_on = 1, slice_ms = 0           -> one ingredient after the other (sequential)
+def build_pour_schedule(durations, max_on, slice_ms):
+    remaining = {}
+    for x in range(PUMP_COUNT):
+        if durations[x] != 0:
+            remaining[x] = durations[x]
+
+    schedule = []
+    running = []
+    t = 0
+    while len(remaining) > 0:
+        # pick the pumps with the most time left, keeping the running ones on ties (saves relay switching)
+        chosen = sorted(remaining, key=lambda x: (-remaining[x], x not in running, x))[:max_on]
+        for x in running:
+            if x not in chosen:
+                schedule.append((t, x, 'OFF'))  #OFFs go first so we never go over max_on
+        for x in chosen:
+            if x not in running:
+                schedule.append((t, x, 'FORWARD'))
+        running = chosen
+
+        step = min(remaining[x] for x in running)
+        if slice_ms > 0 and len(remaining) > max_on:
+            step = min(step, slice_ms)
+        t += step
+        for x in running:
+            remaining[x] -= step
+            if remaining[x] == 0:
+                del remaining[x]
+                schedule.append((t, x, 'OFF'))
+        running = [x for x in running if x in remaining]
+    return schedule
+
+# Pour schedule for the configured POUR_MODE
+def pour_schedule(durations):
+    if POUR_MODE == 'MIX':
+        return build_pour_schedule(durations, MAX_PUMPS_ON, MIX_SLICE_MS)
+    return build_pour_schedule(durations, PUMP_COUNT, 0)
+
+# How long a schedule takes (ms)
+def schedule_ms(schedule):
+    if len(schedule) == 0:
+        return 0
+    return schedule[-1][0]
+
+# Simulate every drink in the menu collection in all-on, sequential and multiplexed (MIX) modes and
+# print the total pour time and relay switch count for each
+def print_mix_report():
+    print('Mix report - MIX mode: max ' + str(MAX_PUMPS_ON) + ' pumps on, ' + str(MIX_SLICE_MS) + ' ms slices')
+    print(format('Drink', '<32') + format('All-on s/sw', '>14') + format('Sequential s/sw', '>18') + format('Mix s/sw', '>14') + format('Mix best s', '>12'))
+    for m in menus:
+        print(m['MenuName'])
+        for name in m['DrinkNames']:
+            durations = m['Durations'][name]
+            line = '  ' + format(name, '<30')
+            for max_on, slice_ms, width in ((PUMP_COUNT, 0, 14), (1, 0, 18), (MAX_PUMPS_ON, MIX_SLICE_MS, 14)):
+                schedule = build_pour_schedule(durations, max_on, slice_ms)
+                total = 0
+                if len(schedule) > 0:
+                    total = schedule[-1][0]
+                line += format(format(total / 1000, '.1f') + '/' + str(len(schedule)), '>' + str(width))
+            best = max(max(durations), sum(durations) / MAX_PUMPS_ON)  #no MIX schedule can beat this
+            line += format(format(best / 1000, '.1f'), '>12')
+            print(line)
+
+# Bottle layout planner - which bottles to move when switching menus, and one layout that suits the whole collection
+
+# Bottles a compiled menu's drinks pour from (a bottle no drink uses doesn't need a pump)
+def menu_bottles_used(m):
+    used = []
+    for name in m['DrinkNames']:
+        recipe = m['Recipes'][name]
+        for x in range(PUMP_COUNT):
+            if recipe[x] > 0 and m['Bottles'][x] not in used:
+                used.append(m['Bottles'][x])
+    return used
+
+# How many drinks in the collection use each bottle (the bottles worth keeping on a pump)
+def bottle_popularity(menu_list):
+    popularity = {}
+    for m in menu_list:
+        for name in m['DrinkNames']:
+            for x in range(PUMP_COUNT):
+                if m['Recipes'][name][x] > 0:
+                    popularity[m['Bottles'][x]] = popularity.get(m['Bottles'][x], 0) + 1
+    return popularity
+
+# The fewest bottle moves that get the needed bottles onto the pumps. Bottles already loaded stay where they
+# are (recipes are remapped to them instead), so each missing bottle is one move - onto an empty pump first,
+# then in place of the bottle not needed that the collection uses least
+# Returns the new layout and the moves as a list of (pump number, bottle taken off, bottle put on)
+def plan_layout(layout, needed, popularity={}):
+    if len(set(needed)) > PUMP_COUNT:
+        raise ValueError(str(len(set(needed))) + ' bottles needed, only ' + str(PUMP_COUNT) + ' pumps')
+    kept = set()
+    free = []
+    for x in range(PUMP_COUNT):
+        if layout[x] in needed and layout[x] not in kept:
+            kept.add(layout[x])
+        else:
+            free.append(x)
+    free.sort(key=lambda x: (layout[x] != '', layout[x] not in kept, popularity.get(layout[x], 0)))  #empty pumps, then duplicates
+    new_layout = list(layout)
+    moves = []
+    for bottle in needed:
+        if bottle not in kept:
+            x = free.pop(0)
+            moves.append((x+1, layout[x], bottle))
+            new_layout[x] = bottle
+            kept.add(bottle)
+    return new_layout, moves
+
+# One set of PUMP_COUNT bottles that lets as many drinks as possible across the collection be poured
+# Each drink is a bitmask of the bottles it uses (drinks with the same bottles are counted together), so the drinks
+# a set of bottles covers are the submasks of its mask - at most 2^PUMP_COUNT lookups however big the collection.
+# Greedy max-coverage: keep adding the drink that covers the most new drinks per extra bottle (and, as a second
+# try, the most new drinks outright), then fill any pumps left with the most used bottles
+# Returns (bottles, drinks covered, total drinks)
+def shared_layout(menu_list):
+    bits = {}
+    names = []
+    drink_masks = {}
+    total = 0
+    for m in menu_list:
+        for name in m['DrinkNames']:
+            mask = 0
+            for x in range(PUMP_COUNT):
+                if m['Recipes'][name][x] > 0:
+                    bottle = m['Bottles'][x]
+                    if bottle not in bits:
+                        bits[bottle] = 1 << len(names)
+                        names.append(bottle)
+                    mask |= bits[bottle]
+            drink_masks[mask] = drink_masks.get(mask, 0) + 1
+            total += 1
+
+    covered_cache = {}
+    def covered(mask):
+        if mask not in covered_cache:
+            count = 0
+            sub = mask
+            while True:
+                count += drink_masks.get(sub, 0)
+                if sub == 0:
+                    break
+                sub = (sub - 1) & mask
+            covered_cache[mask] = count
+        return covered_cache[mask]
+
+    best = 0
+    for per_bottle in (True, False):
+        chosen = 0
+        while True:
+            pick = None
+            for union in set(chosen | mask for mask in drink_masks):
+                extra = bin(union).count('1') - bin(chosen).count('1')
+                if extra == 0 or bin(union).count('1') > PUMP_COUNT:
+                    continue
+                gain = covered(union) - covered(chosen)
+                score = (gain / extra, gain) if per_bottle else (gain, -extra)
+                if pick is None or score > pick[0]:
+                    pick = (score, union)
+            if pick is None:
+                break
+            chosen = pick[1]
+        if covered(chosen) > covered(best):
+            best = chosen
+
+    layout = [names[n] for n in range(len(names)) if (best >> n) & 1]
+    popularity = bottle_popularity(menu_list)
+    for bottle in sorted(names, key=lambda b: -popularity[b]):
+        if len(layout) < PUMP_COUNT and bottle not in layout:
+            layout.append(bottle)
+    return layout, covered(best), total
+
+# --plan-layout: the bottle moves from each station's loaded layout to each menu, and the best shared layout
+def print_layout_plan():
+    popularity = bottle_popularity(menus)
+    bottles, covered, total = shared_layout(menus)
+    ready = len([m for m in menus if all(bottle in bottles for bottle in menu_bottles_used(m))])
+    for station in stations:
+        layout = loaded_layout(station)
+        print('Loaded (' + station['name'] + '): ' + ', '.join(str(x+1) + ' ' + (layout[x] or '-') for x in range(PUMP_COUNT)))
+        for m in menus:
+            new_layout, moves = plan_layout(layout, menu_bottles_used(m), popularity)
+            print('  ' + format(m['MenuName'], '<30') + count_moves(moves))
+
+    print('Shared layout - ' + str(covered) + ' of ' + str(total) + ' drinks, ' + str(ready) + ' of ' + str(len(menus)) + ' whole menus:')
+    for station in stations:
+        new_layout, moves = plan_layout(loaded_layout(station), bottles, popularity)
+        print('  ' + station['name'] + ': ' + ', '.join(str(x+1) + ' ' + (new_layout[x] or '-') for x in range(PUMP_COUNT)))
+        print('    from loaded: ' + count_moves(moves))
+
+def count_moves(moves):
+    if len(moves) == 0:
+        return 'ready (no moves)'
+    return str(len(moves)) + ' moves: ' + format_moves(moves)
+
+def format_moves(moves):
+    return ', '.join('pump ' + str(pump_num) + ' ' + (off or '(empty)') + ' -> ' + on for pump_num, off, on in moves)
+
+# A menu is loaded when a station has the bottles for all of its drinks
+def menu_loaded(index):
+    return any(len(station['pours'][index]) == len(menus[index]['DrinkNames']) for station in stations)
+
+menus = compile_menus(menu_json)
+compile_all_pours()
+for x in range(len(menus)):  #start on the first menu the loaded bottles can pour
+    if menu_loaded(x):
+        chosen_menu_index = x
+        break
+startup_phase('Menu load')
+
+if args.plan_layout:  #print the bottle layout plans and quit
+    print_layout_plan()
+    sys.exit()
+
+if args.mix_report:  #print the mix simulation and quit
+    print_mix_report()
+    sys.exit()
+
+# Calibration run - pump forward for CALIBRATION_RUN_MS, then the user enters what it poured
+# The run is a job for the station's pour dispatcher like the maintenance programs, so it never runs over a pour, and
+# it waits on maintenance_cancel so ALL OFF stops it. A cancelled run can't be saved
+CALIBRATION_JOB = 'Calibration'
+calibration_run_ms = 0  #measured on-time of the last calibration run (0 while running, or if it was cancelled)
+
+def run_calibration():
+    global calibration_run_ms
+    station = control_station()
+    with pour_queue_cv:
+        if station['maintenance_program'] is None and station['maintenance_running'] is None:
+            station['calibration_pump'] = int(calibration_pump.value)
+            calibration_run_ms = 0
+    rejected = start_maintenance(station, CALIBRATION_JOB)
+    if rejected != '':
+        calibration_text.value = rejected
+
+# Run on the station's dispatcher thread
+def calibration_job(station):
+    global calibration_run_ms
+    pump_num = station['calibration_pump']
+    cancel = station['maintenance_cancel']
+    publish_event('calibration', {'text': "Pump " + str(pump_num) + " running...", 'running': True})
+    set_pumps(station, {pump_num: 'FORWARD'}, {pump_num: CALIBRATION_RUN_MS})
+    time_start = time.monotonic()
+    cancelled = cancel.wait(CALIBRATION_RUN_MS / 1000)
+    set_pumps(station, {pump_num: 'OFF'})
+    if cancelled:
+        publish_event('calibration', {'text': "Calibration cancelled - run it again", 'running': False})
+    else:
+        calibration_run_ms = (time.monotonic() - time_start) * 1000
+        publish_event('calibration', {'text': "Enter the ounces poured and Save", 'running': False})
+
+# Save the measured volume for the selected pump as its new rate (or as its bottle's rate, if the bottle has its
+# own entry), and recompile the menus to use it
+def save_calibration_volume():
+    global menus
+    pump_num = int(calibration_pump.value)
+    try:
+        ounces = float(calibration_volume.value)
+    except ValueError:
+        ounces = 0
+    if ounces <= 0 or calibration_run_ms == 0:
+        calibration_text.value = "Run the pump, then enter the ounces poured"
+        return
+    station = control_station()
+    bottle = station['bottles'][pump_num-1]
+    entry = calibration['Bottles'].get(bottle)  #a Bottles entry wins in pump_calibration, so update that one when there is one
+    if entry is None:
+        entry = calibration['Pumps'].setdefault(pump_key(station, pump_num), {})
+    entry['Rate'] = round(calibration_run_ms / (ounces * 10), 1)
+    save_calibration()
+    menus = compile_menus(menu_json)
+    compile_all_pours()
+    update_calibration_text()
+
+# Show the current rate of the selected pump, and whether it comes from the bottle's entry
+def update_calibration_text(value=None):
+    station = control_station()
+    pump_num = int(calibration_pump.value)
+    bottle = station['bottles'][pump_num-1]
+    rate, prime = pump_calibration(station, pump_num, bottle)
+    source = " (bottle entry)" if bottle in calibration['Bottles'] else ""
+    calibration_text.value = (bottle or "(empty)") + ": " + str(rate) + " ms / 0.1 oz" + source
+
+# The station the Control Panel works on (picked in its Station box when there is more than one)
+control_station_combo = None
+
+def control_station():
+    if control_station_combo is None:
+        return stations[0]
+    return station_by_name[control_station_combo.value]
+
+# A different station picked on the Control Panel
+def select_control_station(value=None):
+    update_calibration_text()
+    update_inventory_display()
+
+#Functions for entering the screens (Main, Menu, Control, Tweak)
+# Show one screen and hide the others (the Menu, Control and Tweak screens are only built when first opened)
+def show_panel(window):
+    window.show()
+    window.focus()
+    for other in (window_main_menu_panel, window_menu_select_panel, window_control_panel, window_tweak_panel, window_queue_panel):
+        if other is not None and other is not window:
+            other.hide()
 
-#Functions for entering the three screens (Main, Menu, Control)
 def enter_main_panel():
     update_main_panel()
-    window_main_menu_panel.show()
-    window_main_menu_panel.focus()
-    window_control_panel.hide()
-    window_menu_select_panel.hide()
+    show_panel(window_main_menu_panel)
 
 def enter_menu_panel():
     global menu_index
     global chosen_menu_index
+    if window_menu_select_panel is None:
+        build_menu_select_panel()
     menu_index = chosen_menu_index  # start with the current active menu
     update_menu_panel()
-    window_menu_select_panel.show()
-    window_menu_select_panel.focus()
-    window_main_menu_panel.hide()
-    window_control_panel.hide()
+    show_panel(window_menu_select_panel)
 
 def enter_control_panel():
-    window_control_panel.show()
-    window_control_panel.focus()
-    window_main_menu_panel.hide()
-    window_menu_select_panel.hide()
+    if window_control_panel is None:
+        build_control_panel()
+        update_inventory_display()
+    show_panel(window_control_panel)
 
 def next_menu():
-    global menu_index
+    global menu_index, layout_plan_menu
     menu_index += 1
+    layout_plan_menu = None
     update_menu_panel()
 
 def prev_menu():
-    global menu_index
+    global menu_index, layout_plan_menu
     menu_index -= 1
+    layout_plan_menu = None
     update_menu_panel()
 
+# Selecting a menu whose bottles aren't on the pumps shows the bottles to move first - the second tap on
+# Select (once they have been moved) loads the new layout
 def select_menu():
     global menu_index
     global chosen_menu_index
-
-    window_main_menu_panel.show()
-    window_main_menu_panel.focus()
-    window_control_panel.hide()
-    window_menu_select_panel.hide()
+    global layout_plan_menu
+
+    layouts, moves = plan_station_layouts(menu_index)
+    if len(moves) > 0:
+        if layout_plan_menu != menu_index:
+            layout_plan_menu = menu_index
+            message_menu_plan.value = layout_plan_text(menu_index) + " - then tap Select again"
+            return
+        if not load_layout(layouts):
+            message_menu_plan.value = "Wait for the queued drinks to finish before moving bottles"
+            return
+    layout_plan_menu = None
+
+    show_panel(window_main_menu_panel)
     chosen_menu_index = menu_index #set the chosen menu to the user selection
     update_main_panel() #Now rebuild the Main screen
 
 # Main panel update for the chosen_menu_index (update Menu Name name, Drink buttons)
 def update_main_panel():
-    global chosen_menu_index
-    #repopulate the drink list for this menu
-    main_drinks_list.clear()  # clear the existing drink list
-    y = 0  # ListBox entry index
-    for x in menu_json['Menu'][chosen_menu_index]['Drink']: #now repopulate it
-        main_drinks_list.insert(y, x['Name'])
-        y = y+1
-    main_drinks_list.text_size = "30"
-    main_drinks_list.text_color = "blue"
+    global main_panel_key
+    key = (chosen_menu_index, menu_json.get('DateLastModified', ''))
+    if key != main_panel_key:  #only rebuild the drink list when the menu has changed
+        set_listbox_items(main_drinks_list, render_menu(chosen_menu_index)['DrinkNames'])
+        main_panel_key = key
+    update_inventory_display()
+
+# Replace all the items of a ListBox in one go (one Tk call rather than one per item)
+def set_listbox_items(listbox, items):
+    listbox.clear()  # clear the existing drink list
+    if HEADLESS:
+        listbox.items = list(items)
+    else:
+        listbox._listbox.tk.insert("end", *items)
+
+# Rendered screen content for a menu, built once and cached by menu index and the menu file's DateLastModified
+#   DrinkNames - ListBox items for the Main screen
+#   MenuName, Bottles, Drinks - text for the Menu selection screen
+menu_render_cache = {}
+main_panel_key = None   #cache key of what is on the Main screen now
+menu_panel_key = None   #cache key of what is on the Menu selection screen now
+
+def render_menu(index):
+    key = (index, menu_json.get('DateLastModified', ''))
+    rendered = menu_render_cache.get(key)
+    if rendered is None:
+        m = menus[index]
+        drinks = "Drinks: \n"
+        for name in m['DrinkNames']:
+            drinks += name + "\n" + str(m['Recipes'][name]) + "\n"
+        rendered = {'DrinkNames': tuple(m['DrinkNames']), 'MenuName': m['MenuName'], 'Bottles': str(m['Bottles']), 'Drinks': drinks}
+        menu_render_cache[key] = rendered
+    return rendered
+
+# Render the menus either side of this one ahead of time so Prev/Next only has to swap in the text
+def prefetch_menus(index):
+    for neighbour in (index - 1, index + 1):
+        if 0 <= neighbour < len(menus):
+            render_menu(neighbour)
+
+# Grey out the drinks that no station can pour with what's left in its bottles, warn about bottles running low,
+# and list the bottle levels / time to empty of the Control Panel's station
+def update_inventory_display():
+    names = menus[chosen_menu_index]['DrinkNames']
+    if not HEADLESS:
+        for y in range(len(names)):
+            if any(can_pour(station, chosen_menu_index, names[y]) for station in stations):
+                main_drinks_list._listbox.tk.itemconfig(y, foreground="blue")
+            else:
+                main_drinks_list._listbox.tk.itemconfig(y, foreground="grey")
+
+    low = []
+    levels = ''
+    for station in stations:
+        bottles = station['bottles']
+        for x in range(PUMP_COUNT):
+            if bottles[x] == '':
+                continue
+            level = bottle_level(station, bottles[x])
+            minutes = bottle_minutes_left(station, bottles[x])
+            if station is control_station():
+                levels += str(x+1) + ' ' + bottles[x] + ': ' + format(level, '.1f') + ' oz'
+                if minutes is not None:
+                    levels += ' (~' + str(int(minutes)) + ' min)'
+                levels += '\n'
+            if level < LOW_LEVEL_OZ or (minutes is not None and minutes < LOW_LEVEL_MINUTES):
+                if len(stations) > 1:
+                    low.append(bottles[x] + ' (' + station['name'] + ')')
+                else:
+                    low.append(bottles[x])
+    if len(low) > 0:
+        inventory_warning_text.value = "Running low: " + ", ".join(low)
+    else:
+        inventory_warning_text.value = ""
+    if window_control_panel is not None:
+        inventory_levels_text.value = levels
+
+# Refill the bottle on the pump selected in the Control Panel
+def refill_selected_bottle():
+    station = control_station()
+    refill_bottle(station, station['bottles'][int(inventory_pump.value)-1])
+    update_inventory_display()
+
+def refill_all_bottles():
+    station = control_station()
+    for bottle in station['bottles']:
+        if bottle != '':
+            refill_bottle(station, bottle)
+    update_inventory_display()
 
 # Menu panel update for the menu_index (update Menu Name name, Bottles and Drink Names)
 def update_menu_panel():
-    global menu_index
-    message_menu1.clear()
-    message_menu1.value = menu_json['Menu'][menu_index]['MenuName']
-    message_menu3.clear()
-    message_menu3.value = menu_json['Menu'][menu_index]['Bottles']
-    menu_menu_drink_list.clear()
-    menu_menu_drink_list.value = "Drinks: "
-
-    for x in menu_json['Menu'][menu_index]['Drink']:
-        #menu_menu_drink_list.append(x['Name'])
-        menu_menu_drink_list.append(x['Name'])
-        menu_menu_drink_list.append(x['Recipe'])
-        menu_menu_drink_list.font = "helvetica"
-        menu_menu_drink_list.text_size = "25"
-        menu_menu_drink_list.text_color = "red"
+    global menu_panel_key
+    if window_menu_select_panel is None:  #not built yet - it is drawn when first opened
+        return
+    key = (menu_index, menu_json.get('DateLastModified', ''))
+    if key != menu_panel_key:
+        rendered = render_menu(menu_index)
+        message_menu1.value = rendered['MenuName']
+        message_menu3.value = rendered['Bottles']
+        menu_menu_drink_list.value = rendered['Drinks']
+        message_menu_plan.value = layout_plan_text(menu_index)
+        menu_panel_key = key
+        app.after(50, prefetch_menus, [menu_index])  #once the screen has been drawn
 
     # Prevent user from going out of bounds on the menu array
-    if len(menu_json['Menu']) == (menu_index + 1):  #last entry in the Menu array so don't allow "Next"
+    if len(menus) == (menu_index + 1):  #last entry in the Menu array so don't allow "Next"
         button_next_menu.enabled = False
     else: button_next_menu.enabled = True
     if (menu_index == 0):                       #first entry in the Menu array so don't allow "Prev"
         button_prev_menu.enabled = False
     else: button_prev_menu.enabled = True
 
-# Thread function for handling drink pours (so the entire app isn;t locked up during)
-def thread_function(value):
-    x = threading.Thread(target=pour_drink, args=(value,))
-    x.start()
+# Bottles to move to pour a menu (shown on the Menu screen)
+layout_plan_menu = None     #menu whose bottle moves were shown by the last tap on Select
+popularity_cache = (None, None)
+
+def collection_popularity():
+    global popularity_cache
+    if popularity_cache[0] is not menus:
+        popularity_cache = (menus, bottle_popularity(menus))
+    return popularity_cache[1]
+
+# Every station gets the menu's bottles. Returns the new layout of each station (by name) and the moves,
+# as a list of (station, moves) for the stations with bottles to move
+def plan_station_layouts(index):
+    layouts = {}
+    moves = []
+    for station in stations:
+        layout, station_moves = plan_layout(loaded_layout(station), menu_bottles_used(menus[index]), collection_popularity())
+        layouts[station['name']] = layout
+        if len(station_moves) > 0:
+            moves.append((station, station_moves))
+    return layouts, moves
+
+def layout_plan_text(index):
+    layouts, moves = plan_station_layouts(index)
+    if len(moves) == 0:
+        return ""
+    if len(stations) == 1:
+        return "Move bottles: " + format_moves(moves[0][1])
+    return "Move bottles: " + "; ".join(station['name'] + ": " + format_moves(station_moves) for station, station_moves in moves)
+
+# The bottles have been moved - recompile the pour tables for the new layouts (not while drinks are queued for the old ones)
+def load_layout(layouts):
+    global main_panel_key, menu_panel_key
+    with pour_queue_cv:
+        if any(station['pour_active'] or len(station['queue']) > 0 for station in stations):
+            return False
+        for station in stations:
+            set_loaded_layout(station, layouts[station['name']])
+        compile_all_pours()
+    menu_render_cache.clear()
+    main_panel_key = None
+    menu_panel_key = None
+    return True
+
+# Menu.json hot reload
+# A watcher thread checks the file every MENU_WATCH_INTERVAL seconds. A changed file is parsed and compiled on that thread,
+# then apply_menu_reload() (on the UI thread) swaps it in between pours, keeping the chosen menu by MenuName
+MENU_WATCH_INTERVAL = 2
+pending_menu_reload = None  #(menu_json, menus, each station's (bottles, pour table)) waiting to be swapped in
+menu_reload_lock = threading.Lock()  #guards pending_menu_reload - a newer edit replaces one not yet swapped in
+
+def menu_file_stamp():
+    try:
+        st = os.stat(MENU_FILE)
+    except OSError:  #being replaced right now - look again next time
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def menu_watcher():
+    global pending_menu_reload
+    stamp = menu_file_stamp()
+    last_error = None
+    while True:
+        sleep(MENU_WATCH_INTERVAL)
+        new_stamp = menu_file_stamp()
+        if new_stamp is None or new_stamp == stamp:
+            continue
+        try:
+            with open(MENU_FILE) as f:
+                new_json = json.load(f)
+            new_menus = compile_menus(new_json)
+            new_pours = [compile_pours(station, new_menus) for station in stations]
+            with menu_reload_lock:
+                pending_menu_reload = (new_json, new_menus, new_pours)
+        except Exception as e:  #bad edit or file being replaced - keep pouring from the menus we have and look again next time
+            error = type(e).__name__ + ': ' + str(e)
+            if error != last_error:  #once per problem, not every MENU_WATCH_INTERVAL
+                print('Menu.json not reloaded: ' + error)
+                last_error = error
+            continue
+        stamp = new_stamp
+        last_error = None
+
+def apply_menu_reload():
+    global menu_json, menus, pending_menu_reload
+    global chosen_menu_index, menu_index, main_panel_key, menu_panel_key, tweak_drink, tweak_dirty
+    if pending_menu_reload is None:
+        return
+    with pour_queue_cv:
+        if any(station['pour_active'] for station in stations):  #try again after these pours
+            return
+        with menu_reload_lock:  #take it and clear it in one step, so an edit published meanwhile isn't lost
+            new_json, new_menus, new_pours = pending_menu_reload
+            pending_menu_reload = None
+
+        # Find each menu again by name (a menu that has gone falls back to the first one)
+        new_index = {}
+        for x in range(len(new_menus)):
+            new_index.setdefault(new_menus[x]['MenuName'], x)
+        def remap(index):
+            return new_index.get(menus[index]['MenuName'], 0)
+
+        # Queued orders follow their menu - drop the ones for drinks that no longer exist (or the station can't pour now)
+        for station, (bottles, pours) in zip(stations, new_pours):
+            if bottles != loaded_layout(station):  #bottles moved since the watcher compiled it
+                bottles, pours = compile_pours(station, new_menus)
+            orders = list(station['queue'])
+            station['queue'].clear()
+            for order_menu_index, value, queued_at, recipe in orders:
+                if menus[order_menu_index]['MenuName'] in new_index and value in pours[remap(order_menu_index)]:
+                    station['queue'].append((remap(order_menu_index), value, queued_at, recipe))
+            station['bottles'], station['pours'] = bottles, pours
+
+        # So does a drink open in the Tweak screen (its bottles may have moved, so the estimate is redone)
+        if tweak_drink is not None:
+            if menus[tweak_drink[0]]['MenuName'] in new_index and tweak_drink[1] in new_menus[remap(tweak_drink[0])]['Durations']:
+                tweak_drink = (remap(tweak_drink[0]), tweak_drink[1])
+            else:
+                tweak_drink = None
+            tweak_dirty = True
+
+        main_changed = menus[chosen_menu_index] != new_menus[remap(chosen_menu_index)]
+        menu_changed = menus[menu_index] != new_menus[remap(menu_index)]
+        chosen_menu_index = remap(chosen_menu_index)
+        menu_index = remap(menu_index)
+        menu_json = new_json
+        menus = new_menus
+
+    # Redraw only the screens showing a menu that changed
+    menu_render_cache.clear()
+    if main_changed:
+        main_panel_key = None
+    else:
+        main_panel_key = (chosen_menu_index, menu_json.get('DateLastModified', ''))
+    if menu_changed:
+        menu_panel_key = None
+    else:
+        menu_panel_key = (menu_index, menu_json.get('DateLastModified', ''))
+    update_main_panel()
+    update_menu_panel()
+    publish_event('queue', queue_status())
+    print('Menu.json reloaded')
 
-# Pour a drink recipe with upto 8 liquid ingredients poured in parallel
+# ListBox tap handler - queue the drink for the pour dispatcher (so the entire app isn't locked up during a pour)
+# After the Tweak button the next tap opens the drink in the Tweak screen instead
+def thread_function(value):
+    global tweak_armed
+    if tweak_armed:
+        tweak_armed = False
+        button_tweak.bg = "#cccccc" #grey
+        enter_tweak_panel(value)
+        return
+    update_queue_text(queue_drink(value))
+
+# Tweak drink - the Tweak button arms the drink list, then a tap on a drink opens its sliders
+# The sliders only flag a change; the estimate is worked out on a timer so dragging a slider on the
+# touchscreen (dozens of events a second) costs one recalculation per TWEAK_REFRESH_MS
+TWEAK_MAX = 60              #Most an ingredient slider goes to (1/10th oz)
+TWEAK_REFRESH_MS = 150
+tweak_armed = False
+tweak_drink = None          #(menu index, drink name) in the Tweak screen
+tweak_base = ()             #the drink's own recipe, used for each ingredient until its slider is moved
+tweak_dirty = False
+
+def arm_tweak():
+    global tweak_armed
+    tweak_armed = not tweak_armed
+    if tweak_armed:
+        button_tweak.bg = "#ffcc00" #yellow
+        update_queue_text("Tap a drink to tweak")
+    else:
+        button_tweak.bg = "#cccccc" #grey
+
+def enter_tweak_panel(value):
+    global tweak_drink, tweak_base, tweak_dirty
+    if window_tweak_panel is None:
+        build_tweak_panel()
+    tweak_drink = (chosen_menu_index, value)
+    recipe = menus[chosen_menu_index]['Recipes'][value]
+    bottles = menus[chosen_menu_index]['Bottles']
+    tweak_base = tuple(recipe)
+    tweak_title.value = value
+    for x in range(PUMP_COUNT):
+        tweak_rows[x].visible = recipe[x] > 0  #only the drink's own ingredients can be adjusted
+        tweak_labels[x].value = bottles[x]
+        tweak_sliders[x].value = min(int(round(recipe[x])), TWEAK_MAX)
+    tweak_size.value = 100
+    tweak_dirty = True
+    refresh_tweak_estimate()
+    show_panel(window_tweak_panel)
+
+# Slider command - just note the change (see refresh_tweak_estimate)
+def tweak_changed():
+    global tweak_dirty
+    tweak_dirty = True
+
+# The recipe as set on the sliders (1/10th oz per pump), scaled by the size slider
+# A slider still where it started keeps the recipe's own amount (which may not be a whole number or fit on the slider)
+def tweak_recipe():
+    size = int(tweak_size.value) / 100
+    recipe = []
+    for x in range(PUMP_COUNT):
+        if tweak_rows[x].visible:
+            amount = int(tweak_sliders[x].value)
+            if amount == min(int(round(tweak_base[x])), TWEAK_MAX):
+                amount = tweak_base[x]
+            recipe.append(amount * size)
+        else:
+            recipe.append(0)
+    return tuple(recipe)
+
+# Recalculate the pour time and volume estimate if a slider has moved since the last time
+def refresh_tweak_estimate():
+    global tweak_dirty
+    if not tweak_dirty or tweak_drink is None:
+        return
+    tweak_dirty = False
+    recipe = tweak_recipe()
+    bottles = menus[tweak_drink[0]]['Bottles']
+    durations = recipe_durations(stations[0], recipe, bottles)
+    for station in stations:  #timed on the pumps of the first station with the bottles
+        station_recipe = remap_recipe(recipe, bottles, station['bottles'])
+        if station_recipe is not None:
+            durations = recipe_durations(station, station_recipe, station['bottles'])
+            break
+    pour_ms = schedule_ms(pour_schedule(durations))
+    for x in range(PUMP_COUNT):
+        if tweak_rows[x].visible:
+            tweak_amounts[x].value = format(recipe[x] / 10, '.1f') + " oz"
+    tweak_estimate_text.value = format(sum(recipe_ounces(recipe)), '.1f') + " oz in about " + format(pour_ms / 1000, '.1f') + " s"
+
+def pour_tweaked_drink():
+    if tweak_drink is None:  #the drink went in a Menu.json reload
+        enter_main_panel()
+        return
+    refresh_tweak_estimate()
+    rejected = queue_drink(tweak_drink[1], tweak_drink[0], tapped=False, recipe=tweak_recipe())
+    if rejected != '':
+        tweak_estimate_text.value = rejected
+        return
+    enter_main_panel()
+    update_queue_text()
+
+# Add a drink order to the pour queue (from the chosen menu unless another menu index is given)
+# The order goes to the least busy station that has the drink's bottles (and enough left in them)
+# Returns '' if the order was queued, otherwise the reason it was rejected
+# Only touchscreen taps are checked for duplicates - two staff tablets may well order the same drink
+# recipe overrides the menu's recipe for this one order (a tweaked drink) - the menu itself is left alone
+def queue_drink(value, order_menu_index=None, tapped=True, recipe=None):
+    global touchscreen_debounce
+    global last_queued_drink
+
+    if order_menu_index is None:
+        order_menu_index = chosen_menu_index
+    with pour_queue_cv:
+        candidates = []
+        if value in menus[order_menu_index]['Recipes']:
+            for station in stations:
+                station_recipe = order_recipe(station, order_menu_index, value, recipe)
+                if station_recipe is not None:
+                    candidates.append((station, station_recipe))
+        if value not in menus[order_menu_index]['Recipes']:
+            rejected = "Unknown drink"
+        elif recipe is not None and not any(amount > 0 for amount in recipe):
+            rejected = "Nothing to pour"
+        elif len(candidates) == 0:
+            rejected = "Bottles for " + value + " aren't loaded"
+        elif tapped and value == last_queued_drink and time.monotonic() < (touchscreen_debounce + TOUCHSCREEN_DEBOUNCE / SPEED): #same drink tapped twice
+            rejected = "Duplicate tap ignored"
+        elif all(len(station['queue']) >= POUR_QUEUE_SIZE for station, station_recipe in candidates):
+            rejected = "Queue is full"
+        else:
+            candidates = [(station_busy_ms(station), station['index'], station, station_recipe) for station, station_recipe in candidates
+                          if len(station['queue']) < POUR_QUEUE_SIZE and can_pour(station, order_menu_index, value, station_recipe)]
+            if len(candidates) == 0:
+                rejected = "Not enough left for a " + value
+            else:
+                rejected = ''
+                busy_ms, index, station, station_recipe = min(candidates, key=lambda candidate: candidate[:2])
+                if recipe is None:
+                    station_recipe = None  #poured from the station's pour table
+                station['queue'].append((order_menu_index, value, time.monotonic(), station_recipe))
+                if tapped:
+                    last_queued_drink = value
+                    touchscreen_debounce = time.monotonic()  #snap shot the current time
+                pour_queue_cv.notify_all()
+
+    if rejected == '':
+        publish_event('queue', queue_status())
+    return rejected
+
+# An order's recipe in a station's pump order (None if the station doesn't have the bottles)
+def order_recipe(station, order_menu_index, value, recipe=None):
+    if recipe is None:
+        pour = station['pours'][order_menu_index].get(value)
+        if pour is None:
+            return None
+        return pour[0]
+    return remap_recipe(recipe, menus[order_menu_index]['Bottles'], station['bottles'])
+
+# How long (ms) until a station gets through the pour it is on and its queue (caller holds pour_queue_cv)
+def station_busy_ms(station):
+    busy_ms = 0
+    if station['pour_active']:
+        busy_ms = max(0, (station['pour_ends'] - time.monotonic()) * 1000)
+    for order_menu_index, value, queued_at, recipe in station['queue']:
+        if recipe is None:
+            busy_ms += station['pours'][order_menu_index][value][2]
+        else:
+            busy_ms += schedule_ms(pour_schedule(recipe_durations(station, recipe, station['bottles'])))
+    return busy_ms
+
+# What is pouring and what is waiting (pouring and queued cover every station - stations has each one's own)
+def queue_status():
+    with pour_queue_cv:
+        queued = []
+        for station in stations:
+            for order_menu_index, value, queued_at, recipe in station['queue']:
+                queued.append((queued_at, {'menu': menus[order_menu_index]['MenuName'], 'drink': value, 'station': station['name']}))
+        queued.sort(key=lambda order: order[0])
+        pouring = [station['pouring_drink'] for station in stations if station['pouring_drink'] is not None]
+        return {'pouring': pouring[0] if len(pouring) > 0 else None, 'queued': [order for queued_at, order in queued],
+                'stations': [{'name': station['name'], 'pouring': station['pouring_drink'], 'queued': len(station['queue'])} for station in stations]}
+
+# Is there enough left in the station's bottles to pour the drink, counting the drinks already queued there
+# recipe is the order's recipe in the station's pump order (the pour table's recipe if not given)
+def can_pour(station, pour_menu_index, value, recipe=None):
+    if recipe is None:
+        recipe = order_recipe(station, pour_menu_index, value)
+        if recipe is None:
+            return False
+    bottles = station['bottles']
+    needed = [0] * PUMP_COUNT
+    for order_menu_index, name, queued_at, queued_recipe in list(station['queue']) + [(pour_menu_index, value, 0, recipe)]:
+        if queued_recipe is None:
+            queued_recipe = station['pours'][order_menu_index][name][0]
+        ounces = recipe_ounces(queued_recipe)
+        for x in range(PUMP_COUNT):
+            needed[x] += ounces[x]
+    for x in range(PUMP_COUNT):
+        if needed[x] > 0 and needed[x] > bottle_level(station, bottles[x]):
+            return False
+    return True
+
+# Cancel a waiting drink order, whichever station it is on (the ones being poured are not affected)
+# position is its place among all the waiting orders, oldest first as queue_status() lists them (0 = the next to pour,
+# -1 = the most recently queued). If drink is given the order there must be that drink - the list may have moved on
+# since it was shown. Returns False if there is no such order
+def cancel_queued_drink(position=-1, drink=None):
+    global last_queued_drink
+    with pour_queue_cv:
+        queued = [(order[2], station, order) for station in stations for order in station['queue']]
+        queued.sort(key=lambda entry: entry[0])
+        if not -len(queued) <= position < len(queued):
+            return False
+        queued_at, station, order = queued[position]
+        if drink is not None and order[1] != drink:
+            return False
+        station['queue'].remove(order)
+        last_queued_drink = ''
+    publish_event('queue', queue_status())
+    return True
+
+# Show the number of drinks waiting next to the pour banner (or, for a couple of seconds, why an order was rejected)
+QUEUE_MESSAGE_TIME = 2.0
+queue_message_until = 0
+
+def update_queue_text(message=''):
+    global queue_message_until
+    waiting = sum(len(station['queue']) for station in stations)
+    if message != '':
+        drink_queue_text.value = "  " + message
+        queue_message_until = time.monotonic() + QUEUE_MESSAGE_TIME
+    elif time.monotonic() < queue_message_until:
+        pass  #leave the message up, the pour display refresh puts the count back afterwards
+    elif waiting > 0:
+        drink_queue_text.value = "  (" + str(waiting) + " queued)"
+    else:
+        drink_queue_text.value = ""
+    button_cancel_queued.enabled = waiting > 0
+
+# Queue screen - the waiting orders, oldest first, to cancel any one of them (or the last one queued)
+queue_panel_drinks = []     #drink of each line of the list, to check the order is still there when it is cancelled
+
+def enter_queue_panel():
+    if window_queue_panel is None:
+        build_queue_panel()
+    update_queue_panel()
+    show_panel(window_queue_panel)
+
+def update_queue_panel():
+    global queue_panel_drinks
+    queued = queue_status()['queued']
+    queue_panel_drinks = [order['drink'] for order in queued]
+    lines = []
+    for x, order in enumerate(queued):
+        line = str(x+1) + ". " + order['drink']
+        if len(stations) > 1:
+            line += "  (" + order['station'] + ")"
+        lines.append(line)
+    set_listbox_items(queue_orders_list, lines)
+    queue_panel_text.value = str(len(queued)) + " waiting" if len(queued) > 0 else "Nothing waiting"
+
+def cancel_selected_order():
+    if queue_orders_list.value not in queue_orders_list.items:
+        queue_panel_text.value = "Tap an order first"
+        return
+    position = queue_orders_list.items.index(queue_orders_list.value)
+    if not cancel_queued_drink(position, queue_panel_drinks[position]):
+        queue_panel_text.value = "That order has already gone"
+    update_queue_panel()
+
+def cancel_last_order():
+    cancel_queued_drink()
+    update_queue_panel()
+
+# Pour dispatcher - a long-lived thread per station that pours its queued orders back to back (and runs the maintenance
+# programs and calibration runs)
+def pour_dispatcher(station):
+    while True:
+        with pour_queue_cv:
+            while len(station['queue']) == 0 and station['maintenance_program'] is None:
+                pour_queue_cv.wait()
+            if station['maintenance_program'] is not None:  #maintenance programs go ahead of the queued drinks
+                value = station['maintenance_running'] = station['maintenance_program']
+                station['maintenance_program'] = None
+                station['maintenance_cancel'].clear()
+            else:
+                order_menu_index, value, queued_at, recipe = station['queue'].popleft()
+                station['pour_cancel'].clear()
+            station['pour_active'] = True
+            station['pouring_drink'] = value
+        publish_event('queue', queue_status())
+        try:
+            if value == CALIBRATION_JOB and station['maintenance_running'] is not None:
+                calibration_job(station)
+            elif station['maintenance_running'] is not None:
+                run_maintenance(station, value)
+            else:
+                pour_finished(station, pour_drink(station, value, order_menu_index, queued_at, recipe))
+        except Exception:  #a pour that blew up must not leave its pumps on - stop the station and carry on with the queue
+            traceback.print_exc()
+            set_pumps(station, {pump_num: 'OFF' for pump_num in range(1, PUMP_COUNT+1)})
+            print('All pumps off at ' + station['name'] + ' after a failed ' + value)
+        finally:
+            with pour_queue_cv:
+                station['pour_active'] = False
+                station['pouring_drink'] = None
+                station['pour_ends'] = 0
+                station['maintenance_running'] = None
+            publish_event('queue', queue_status())
+
+# Called by a station's pour dispatcher with the stats of every finished pour
+def pour_finished(station, stats):
+    use_bottles(station, stats['bottles'], stats['ounces'])
+    publish_event('pour_done', {'drink': stats['drink'], 'menu': stats['menu'], 'station': station['name'], 'seconds': round(stats['time'], 3),
+                                'cancelled': stats['cancelled']})
+    if pour_log_path is not None:
+        log_pour(stats)
+    if SIMULATING:
+        sim_pours.append(stats)
+
+# Pour a drink recipe with upto PUMP_COUNT liquid ingredients poured in parallel at a station
 # Drink recipe is specified in 1/10th of an ounce in the Menu.json file
 # Unused pumps/ingredients should be assigned a "0" (zero) in the JSON file
 # Notes: This routine does not return UNTIL the drink has finished pouring. So can not do other activity (e.g. lights control)
-# Might try using timer interrupts (but that's for later)
-def pour_drink(value):
-    global chosen_menu_index
-    global touchscreen_debounce
-
-    main_drinks_list.disable() #disallow the user tapping another drink
-
-    if time.time() < (touchscreen_debounce+1): #debounce in seconds
-        return
-
-    touchscreen_debounce = time.time()  #snap shot the current time
-
-    sleep (0.2) #pause briefly for aesthetics
-
-    drink_pour_label.append("       Pouring a: ") #announce what's being poured at the bottom banner
-    drink_pour_text.append(value)
-
-    # Get the recipe for that index (load into an array)
-    for key in menu_json['Menu'][chosen_menu_index]['Drink']:
-        if (key['Name'] == value):
-            recipe = key['Recipe']
+# The pour thread sleeps until the next pump-off deadline, so it uses next to no CPU while pumps are running. It waits on
+# the station's pour_cancel Event instead of sleeping, so ALL OFF stops the pour at once (and only what was poured is counted)
+# Returns the pour stats: drink, queue wait (s), pour time (s), how late (ms) each scheduled pump step happened,
+# and the commanded and actual on-time (ms) of each pump
+# A tweaked drink passes its own recipe in the station's pump order (timed with the same calibration as the menu's drinks)
+def pour_drink(station, value, pour_menu_index=None, queued_at=None, recipe=None):
+    if pour_menu_index is None:
+        pour_menu_index = chosen_menu_index
+    pour_start = time.monotonic()
+    pour_started_at = time.time()  #wall clock, for the pour log
+    if queued_at is None:
+        queued_at = pour_start
+
+    cancel = station['pour_cancel']
+    cancel.wait(0.2 / SPEED) #pause briefly for aesthetics (shortened with the pour times when simulating)
+
+    # Get the per-pump pour times for that drink
+    tweaked = recipe is not None
+    if recipe is None:
+        recipe, durations, pour_ms = station['pours'][pour_menu_index][value]
+    else:
+        durations = recipe_durations(station, recipe, station['bottles'])
+    bottles = station['bottles']
+    pumps_ON = station['pumps_ON']
+    pour_overshoot = station['pour_overshoot']
 
     # Reset the pump ON flag array
-    for x in range(8):
+    for x in range(PUMP_COUNT):
         pumps_ON[x] = 0
 
-    # Turn on the relevant pumps for this drink recipe
-    for x in range (8):
-        if recipe[x] != 0:
-            drive_pump(x+1,'FORWARD') #turn on pump
-            pumps_ON[x] = 1     #flag that pump as ON
-
-    time_epoch = time.time() * 1000  #get current millisoconds since epoch
-
-    while ((pumps_ON[0] + pumps_ON[1] + pumps_ON[2] + pumps_ON[3] + pumps_ON[4] + pumps_ON[5] + pumps_ON[6] + pumps_ON[7]) != 0): #while there is a pump still on
-        for x in range (8):                     #go through each pump and check the lapsed time vs recipe time / pour
-            if (pumps_ON[x] == 1):
-                if (time.time()*1000 >= (time_epoch + (recipe[x] * PUMP_POUR_RATE * DRINK_SIZE_FACTOR))): #If enough time has passed for a pump pour, turn OFF that pump
-                    drive_pump (x+1, 'OFF')     #Turn off pump
-                    pumps_ON[x] = 0             #also turn off its ON flag
-
-    touchscreen_debounce = time.time()  #start the debounce timer again - snap shot the current time
-
-    drink_pour_label.clear() #clear the drink bottom banner
-    drink_pour_text.clear()
-    main_drinks_list.enable() #re-enable drink selection
+    schedule = pour_schedule(durations)
+    total_ms = schedule_ms(schedule)
+    station['pour_ends'] = time.monotonic() + total_ms / 1000
+    publish_event('pour', {'drink': value, 'menu': menus[pour_menu_index]['MenuName'], 'station': station['name'], 'total_ms': total_ms})
+
+    cpu_start = time.thread_time()  #CPU used by this pour thread (should be close to zero now)
+    time_start = time.monotonic()  #monotonic clock so wall clock changes (NTP etc) can't stretch a pour
+
+    # Turn the pumps on and off as scheduled, sleeping until each step instead of spinning on the clock
+    # Steps due at the same time go out in one batched relay write
+    step_lateness = []
+    expected = {x+1: durations[x] for x in range(PUMP_COUNT) if durations[x] > 0}  #for the watchdog
+    pump_on_at = [0.0] * PUMP_COUNT  #when (ms into the pour) each pump last went on
+    pump_on_ms = [0.0] * PUMP_COUNT  #how long each pump actually ran
+    n = 0
+    while n < len(schedule) and not cancel.is_set():
+        step_time = schedule[n][0]
+        pump_actions = {}
+        while n < len(schedule) and schedule[n][0] == step_time:
+            pump_actions[schedule[n][1]+1] = schedule[n][2]
+            n += 1
+        if wait_for_step(station, value, cancel, time_start, step_time, total_ms):
+            break
+        set_pumps(station, pump_actions, expected)
+        step_done = ((time.monotonic() - time_start) * 1000) - step_time  #how late (ms) the step actually happened
+        step_lateness.append(step_done)
+        publish_event('progress', {'drink': value, 'station': station['name'], 'elapsed_ms': step_time, 'total_ms': total_ms})
+        for pump_num, action in pump_actions.items():
+            if action == 'FORWARD':
+                pumps_ON[pump_num-1] = 1     #flag that pump as ON
+                pump_on_at[pump_num-1] = step_time + step_done
+            else:
+                pumps_ON[pump_num-1] = 0     #also turn off its ON flag
+                pour_overshoot[pump_num-1] = step_done
+                pump_on_ms[pump_num-1] += step_time + step_done - pump_on_at[pump_num-1]
+
+    ounces = recipe_ounces(recipe)
+    cancelled = cancel.is_set()
+    if cancelled:  #ALL OFF - stop the pumps (in case a step went out just as it was pressed) and count only what was poured
+        set_pumps(station, {pump_num: 'OFF' for pump_num in range(1, PUMP_COUNT+1)})
+        stopped_at = (time.monotonic() - time_start) * 1000
+        for x in range(PUMP_COUNT):
+            if pumps_ON[x]:
+                pumps_ON[x] = 0
+                pump_on_ms[x] += stopped_at - pump_on_at[x]
+        ounces = tuple(ounces[x] * min(1.0, pump_on_ms[x] / durations[x]) if durations[x] > 0 else 0.0 for x in range(PUMP_COUNT))
+        print(value + ' cancelled at ' + station['name'])
+    elif POUR_REPORT:
+        print_overshoot_report(station, value, durations, (time.thread_time() - cpu_start) * 1000)
+
+    return {'drink': value, 'menu': menus[pour_menu_index]['MenuName'], 'station': station['index'], 'wait': pour_start - queued_at, 'time': time.monotonic() - pour_start,
+            'lateness': step_lateness, 'bottles': bottles, 'ounces': ounces,
+            'started': pour_started_at, 'durations': durations, 'on_ms': pump_on_ms, 'tweaked': tweaked, 'cancelled': cancelled}
+
+# Wait until a pour step is due (or the pour is cancelled - returns True), publishing a 'progress' event every
+# PROGRESS_EVENT_MS on the way so API clients see the pour move between steps. The last wait still ends on the step time
+PROGRESS_EVENT_MS = 250
+
+def wait_for_step(station, value, cancel, time_start, step_time, total_ms):
+    step_at = time_start + step_time / 1000
+    while True:
+        now = time.monotonic()
+        next_event = now + PROGRESS_EVENT_MS / 1000
+        if next_event >= step_at:
+            return cancel.wait(max(0, step_at - now))
+        if cancel.wait(next_event - now):
+            return True
+        publish_event('progress', {'drink': value, 'station': station['name'], 'elapsed_ms': int((time.monotonic() - time_start) * 1000), 'total_ms': total_ms})
+
+# Ounces poured from each pump for a recipe
+def recipe_ounces(recipe):
+    return tuple(recipe[x] * DRINK_SIZE_FACTOR / 10 for x in range(PUMP_COUNT))
+
+# Print how late (in ms) each pump was last shut off vs its schedule for the last pour, and the CPU time the pour used
+def print_overshoot_report(station, value, durations, cpu_ms):
+    report = ''
+    for x in range(PUMP_COUNT):
+        if durations[x] != 0:
+            report += ' P' + str(x+1) + '=' + format(station['pour_overshoot'][x], '.2f')
+    if len(stations) > 1:
+        value += ' (' + station['name'] + ')'
+    print('Pour overshoot (ms) for ' + value + ':' + report + '  CPU (ms): ' + format(cpu_ms, '.1f'))
+
+# Maintenance programs - prime the lines at opening, purge them back into the bottles / rinse them at closing
+# A program is a list of steps: (pumps, action, ms each pump runs, most pumps on at once). Programs are run by a
+# station's pour dispatcher (so never over a pour - a program goes ahead of the drinks still queued there) with the same
+# schedule builder as a MIX pour, which keeps the supply load to max_on pumps. ALL OFF cancels the program straight away
+MAINT_PRIME_MS = 4000       #long enough to fill an empty line
+MAINT_PURGE_MS = 6000       #long enough to empty a full line back into its bottle
+MAINT_RINSE_MS = 10000      #water through each line (swap the bottles for water first)
+ALL_PUMPS = tuple(range(1, PUMP_COUNT+1))
+MAINTENANCE_PROGRAMS = {
+    'Prime': [(ALL_PUMPS, 'FORWARD', MAINT_PRIME_MS, MAX_PUMPS_ON)],
+    'Purge': [(ALL_PUMPS, 'REVERSE', MAINT_PURGE_MS, MAX_PUMPS_ON)],
+    'Rinse': [(ALL_PUMPS, 'FORWARD', MAINT_RINSE_MS, MAX_PUMPS_ON), (ALL_PUMPS, 'REVERSE', MAINT_PURGE_MS, MAX_PUMPS_ON)],
+}
+# Each station has the program waiting for its dispatcher (maintenance_program) and the one being run (maintenance_running),
+# both guarded by pour_queue_cv, and a maintenance_cancel Event
+
+# Schedule of a program: (time in ms, pump index, action) sorted by time, each step starting when the last one ends
+def maintenance_schedule(program):
+    schedule = []
+    step_start = 0
+    for pumps, action, ms, max_on in program:
+        durations = [0] * PUMP_COUNT
+        for pump_num in pumps:
+            durations[pump_num-1] = int(ms / SPEED)
+        step_schedule = build_pour_schedule(durations, max_on, 0)
+        for t, x, step_action in step_schedule:
+            if step_action == 'FORWARD':
+                step_action = action
+            schedule.append((step_start + t, x, step_action))
+        step_start += schedule_ms(step_schedule)
+    return schedule
+
+# Ask a station's dispatcher to run a program. Returns '' if it was started (or will start after the pour), otherwise why not
+def start_maintenance(station, name):
+    with pour_queue_cv:
+        if station['maintenance_program'] is not None or station['maintenance_running'] is not None:
+            return (station['maintenance_program'] or station['maintenance_running']) + " is already running"
+        station['maintenance_program'] = name
+        waiting = station['pour_active']
+        pour_queue_cv.notify_all()
+    if waiting and name == CALIBRATION_JOB:
+        publish_event('calibration', {'text': name + " starts after this pour", 'running': True})
+    elif waiting:
+        publish_event('maintenance', {'program': name, 'station': station['name'], 'running': False, 'text': name + " starts after this pour"})
+    return ''
+
+# Drop the programs waiting to start and stop the ones running (their pumps are turned off by the caller or the program)
+def cancel_maintenance():
+    dropped = []
+    with pour_queue_cv:
+        for station in stations:
+            dropped.append(station['maintenance_program'])
+            station['maintenance_program'] = None
+            if station['maintenance_running'] is not None:
+                station['maintenance_cancel'].set()
+    if CALIBRATION_JOB in dropped:
+        publish_event('calibration', {'text': "Calibration cancelled - run it again", 'running': False})
+
+# Run a program on a station's dispatcher thread - waits on maintenance_cancel instead of sleeping so a cancel stops it at once
+def run_maintenance(station, name):
+    schedule = maintenance_schedule(MAINTENANCE_PROGRAMS[name])
+    total_ms = schedule_ms(schedule)
+    cancel = station['maintenance_cancel']
+    expected = {}  #longest step of each pump, for the watchdog
+    for pumps, action, ms, max_on in MAINTENANCE_PROGRAMS[name]:
+        for pump_num in pumps:
+            expected[pump_num] = max(expected.get(pump_num, 0), int(ms / SPEED))
+    publish_event('maintenance', {'program': name, 'station': station['name'], 'running': True, 'total_ms': total_ms})
+
+    time_start = time.monotonic()
+    n = 0
+    while n < len(schedule) and not cancel.is_set():
+        step_time = schedule[n][0]
+        pump_actions = {}
+        while n < len(schedule) and schedule[n][0] == step_time:
+            pump_actions[schedule[n][1]+1] = schedule[n][2]
+            n += 1
+        if cancel.wait(max(0, time_start + (step_time / 1000) - time.monotonic())):
+            break
+        set_pumps(station, pump_actions, expected)
+
+    if cancel.is_set():
+        set_pumps(station, {pump_num: 'OFF' for pump_num in ALL_PUMPS})  #in case a step went out just as ALL OFF was pressed
+        text = name + " cancelled"
+    else:
+        text = name + " done"
+    publish_event('maintenance', {'program': name, 'station': station['name'], 'running': False, 'text': text})
+
+# Control Panel program buttons (on the Control Panel's station)
+def maintenance_button(name):
+    rejected = start_maintenance(control_station(), name)
+    if rejected != '':
+        maintenance_text.value = rejected
 
 # Core pump control function
 # Valid pump_action values are: FORWARD, REVERSE, OFF. Any other value turns pump OFF
-# pump_Num is from 1-8
+# pump_Num is from 1-PUMP_COUNT, on the given station (the Control Panel's station if not given)
 # LOW output turns ON the relay (active low)
-def drive_pump(pump_num, pump_action):
-    if pump_action == 'OFF': #turn pump off
-        relay[(pump_num * 2) - 2].on() # find the I/O pins from pin index array and control the two relays
-        relay[(pump_num * 2) - 1].on()
-        #print(str((pump_num * 2) - 2) + ' ON  ', end = '')
-        #print(str((pump_num * 2) - 1) + ' ON')
-    elif pump_action == 'FORWARD': #Pump in forward mode
-        relay[(pump_num * 2) - 2].off()
-        relay[(pump_num * 2) - 1].on()
-        #print(str((pump_num * 2) - 2) + ' OFF  ', end = '')
-        #print(str((pump_num * 2) - 1) + ' ON')
+def drive_pump(pump_num, pump_action, station=None):
+    if station is None:
+        station = control_station()
+    set_pumps(station, {pump_num: pump_action})
+
+# Relay levels (F relay, R relay) for each pump action
+def pump_relay_bits(pump_action):
+    if pump_action == 'FORWARD': #Pump in forward mode
+        return 0, 1
     elif pump_action == 'REVERSE': #Pump in reverse mode
-        relay[(pump_num * 2) - 2].on()
-        relay[(pump_num * 2) - 1].off()
-        #print(str((pump_num * 2) - 2) + ' ON  ', end = '')
-        #print(str((pump_num * 2) - 1) + ' OFF')
+        return 1, 0
     else: #turn pump off by default
-        relay[(pump_num * 2) - 2].on()
-        relay[(pump_num * 2) - 1].on()
-        #print(str((pump_num * 2) - 2) + ' ON  ', end = '')
-        #print(str((pump_num * 2) - 1) + ' ON')
+        return 1, 1
+
+# Drive several of a station's pumps at once: pump_actions is a dict of pump number (1-PUMP_COUNT) -> FORWARD, REVERSE or OFF
+# Every pump in the dict changes in the same batched relay write
+# expected is pump number -> how long (ms) the pumps being turned on should run, for the watchdog (see the watchdog)
+def set_pumps(station, pump_actions, expected=None):
+    with station['relay_lock']:
+        target = station['relay_state']
+        reversing = 0  #relay bits of pumps going straight from FORWARD to REVERSE (or back)
+        for pump_num, pump_action in pump_actions.items():
+            f_bit = (pump_num * 2) - 2 # find the relay pins for this pump
+            r_bit = (pump_num * 2) - 1
+            f_level, r_level = pump_relay_bits(pump_action)
+            pump_mask = (1 << f_bit) | (1 << r_bit)
+            new_bits = (f_level << f_bit) | (r_level << r_bit)
+            old_bits = station['relay_state'] & pump_mask
+            if old_bits != pump_mask and new_bits != pump_mask and old_bits != new_bits:
+                reversing |= pump_mask
+            target = (target & ~pump_mask) | new_bits
+
+        # Break before make - open both relays of a reversing pump and let them settle first
+        if reversing != 0:
+            write_relays(station, station['relay_state'] | reversing)
+            sleep(RELAY_BREAK_TIME)
+        write_relays(station, target)
+        near_misses = watchdog_update(station, pump_actions, expected)
+        pumps = pump_states(target)
+    publish_event('pumps', {'station': station['name'], 'pumps': pumps})
+    for record in near_misses:
+        watchdog_record(record)
+
+# FORWARD / REVERSE / OFF for each pump in a relay state
+def pump_states(state):
+    pumps = []
+    for x in range(PUMP_COUNT):
+        f_level = (state >> (x * 2)) & 1
+        r_level = (state >> (x * 2 + 1)) & 1
+        if f_level == 0 and r_level == 1:
+            pumps.append('FORWARD')
+        elif f_level == 1 and r_level == 0:
+            pumps.append('REVERSE')
+        else:
+            pumps.append('OFF')
+    return pumps
+
+# Apply a relay target state to a station (caller holds its relay_lock). Only the pins that change are written
+def write_relays(station, target):
+    changed = station['relay_state'] ^ target
+    if changed == 0:
+        return
+    pins = station['pins']
+    if station['gpio_bank'] is not None:  #two bank writes: relays off (pins high) first, then relays on (pins low)
+        high_mask = 0
+        low_mask = 0
+        for n in range(len(pins)):
+            if (changed >> n) & 1:
+                if (target >> n) & 1:
+                    high_mask |= 1 << pins[n]
+                else:
+                    low_mask |= 1 << pins[n]
+        if high_mask != 0:
+            station['gpio_bank'].set_bank_1(high_mask)
+        if low_mask != 0:
+            station['gpio_bank'].clear_bank_1(low_mask)
+    else:
+        relay_pins = station['relay_pins']
+        for n in range(len(pins)):
+            if (changed >> n) & 1:
+                relay_pins[n].state = (target >> n) & 1
+    if relay_log is not None:
+        relay_log.append((time.monotonic(), station['index'], station['relay_state'], target))
+    station['relay_state'] = target
 
 def all_pumps_forward():
-    all_pumps_off()
-    sleep(0.05)
-    drive_pump(1, "FORWARD")
-    drive_pump(2, "FORWARD")
-    drive_pump(3, "FORWARD")
-    drive_pump(4, "FORWARD")
-    drive_pump(5, "FORWARD")
-    drive_pump(6, "FORWARD")
-    drive_pump(7, "FORWARD")
-    drive_pump(8, "FORWARD")
+    set_pumps(control_station(), {pump_num: "FORWARD" for pump_num in range(1, PUMP_COUNT+1)})
 
 def all_pumps_reverse():
-    all_pumps_off()
-    sleep(0.05)
-    drive_pump(1, "REVERSE")
-    drive_pump(2, "REVERSE")
-    drive_pump(3, "REVERSE")
-    drive_pump(4, "REVERSE")
-    drive_pump(5, "REVERSE")
-    drive_pump(6, "REVERSE")
-    drive_pump(7, "REVERSE")
-    drive_pump(8, "REVERSE")
+    set_pumps(control_station(), {pump_num: "REVERSE" for pump_num in range(1, PUMP_COUNT+1)})
 
+# ALL OFF turns off every station's pumps and also stops the drinks being poured and any maintenance program
 def all_pumps_off():
-    drive_pump(1, "OFF")
-    drive_pump(2, "OFF")
-    drive_pump(3, "OFF")
-    drive_pump(4, "OFF")
-    drive_pump(5, "OFF")
-    drive_pump(6, "OFF")
-    drive_pump(7, "OFF")
-    drive_pump(8, "OFF")
+    cancel_maintenance()
+    with pour_queue_cv:
+        for station in stations:
+            if station['pour_active'] and station['maintenance_running'] is None:
+                station['pour_cancel'].set()
+    for station in stations:
+        set_pumps(station, {pump_num: "OFF" for pump_num in range(1, PUMP_COUNT+1)})
+
+# Watchdog - a hard limit on how long any pump stays on, whatever happens to the thread that turned it on
+# set_pumps() arms each pump it turns on with a deadline: its expected on-time (the recipe's pour time, a program step,
+# the calibration run) * WATCHDOG_MARGIN + WATCHDOG_SLACK_MS, or WATCHDOG_MANUAL_MS for the Control Panel buttons.
+# Arming is one heap push (turning the pump off just drops the arm), so the pour loop doesn't notice it. The watchdog
+# thread sleeps until the earliest deadline and turns off any pump still on under that arm - it needs nothing from
+# the UI thread or the pour thread. A pump turned off late (past WATCHDOG_NEAR_MISS of its limit) is a near miss.
+# Trips and near misses are printed, kept in watchdog_records and published as 'watchdog' events
+WATCHDOG_MARGIN = 1.5
+WATCHDOG_SLACK_MS = 500
+WATCHDOG_MANUAL_MS = 60000  #Control Panel pump buttons and ALL FORWARD / REVERSE
+WATCHDOG_NEAR_MISS = 0.75   #fraction of the limit
+WATCHDOG_LOCK_TIMEOUT = 0.5 #seconds all_relays_off() waits for a station's relay lock before writing the pins anyway
+watchdog_cv = threading.Condition()
+watchdog_deadlines = []     #heap of (deadline, sequence, station index, pump index, arm)
+watchdog_sequence = itertools.count()
+watchdog_records = deque(maxlen=100)  #the latest trips and near misses
+
+# Arm or disarm a station's pumps for the actions just written (caller holds the station's relay_lock)
+# expected is pump number -> expected on-time (ms) for the pumps being turned on, None for manual use
+# Returns the near misses of the pumps that went off
+def watchdog_update(station, pump_actions, expected):
+    now = time.monotonic()
+    armed = station['watchdog']
+    near_misses = []
+    for pump_num, pump_action in pump_actions.items():
+        x = pump_num - 1
+        arm = armed[x]
+        if arm is not None and arm[4] == pump_action:  #still running the same way - keep the first deadline
+            continue
+        if arm is not None:
+            armed[x] = None
+            on_ms = (now - arm[3]) * 1000
+            if arm[1] is not None and on_ms > arm[2] * WATCHDOG_NEAR_MISS:
+                near_misses.append({'station': station['name'], 'pump': pump_num, 'on_ms': round(on_ms, 1), 'expected_ms': arm[1],
+                                    'limit_ms': arm[2], 'tripped': False})
+        if pump_action in ('FORWARD', 'REVERSE'):
+            expected_ms = None
+            limit_ms = WATCHDOG_MANUAL_MS
+            if expected is not None and pump_num in expected:
+                expected_ms = expected[pump_num]
+                limit_ms = expected_ms * WATCHDOG_MARGIN + WATCHDOG_SLACK_MS
+            arm = (now + limit_ms / 1000, expected_ms, limit_ms, now, pump_action)
+            armed[x] = arm
+            with watchdog_cv:
+                heapq.heappush(watchdog_deadlines, (arm[0], next(watchdog_sequence), station['index'], x, arm))
+                if watchdog_deadlines[0][4] is arm:  #new earliest deadline - wake the watchdog to sleep less
+                    watchdog_cv.notify()
+    return near_misses
+
+# Watchdog thread - turn off every pump whose deadline passes while it is still on under the same arm
+def watchdog_thread():
+    while True:
+        with watchdog_cv:
+            while len(watchdog_deadlines) == 0 or watchdog_deadlines[0][0] > time.monotonic():
+                if len(watchdog_deadlines) == 0:
+                    watchdog_cv.wait()
+                else:
+                    watchdog_cv.wait(watchdog_deadlines[0][0] - time.monotonic())
+            deadline, sequence, station_index, x, arm = heapq.heappop(watchdog_deadlines)
+        station = stations[station_index]
+        with station['relay_lock']:  #nobody can turn the pump off and on again while we look
+            if station['watchdog'][x] is not arm:  #turned off (or re-armed) in time
+                continue
+            station['watchdog'][x] = None
+            set_pumps(station, {x+1: 'OFF'})
+        stop_station_jobs(station)
+        watchdog_record({'station': station['name'], 'pump': x+1, 'on_ms': round((time.monotonic() - arm[3]) * 1000, 1),
+                         'expected_ms': arm[1], 'limit_ms': arm[2], 'tripped': True})
+
+def watchdog_record(record):
+    watchdog_records.append(record)
+    if record['tripped']:
+        text = 'Watchdog turned off'
+    else:
+        text = 'Watchdog near miss:'
+    print(text + ' pump ' + str(record['pump']) + ' (' + record['station'] + ') after ' + format(record['on_ms'], '.0f') + ' ms, limit ' + format(record['limit_ms'], '.0f') + ' ms')
+    publish_event('watchdog', record)
+
+# Stop the pour or program running at a station after its pumps were turned off behind its back, so it doesn't carry
+# on and count the full drink. Only sets Events (no locks) - the dispatcher clears them when it starts its next job
+def stop_station_jobs(station):
+    station['pour_cancel'].set()
+    station['maintenance_cancel'].set()
+
+# Fail-safe - every relay of every station off, straight to the pins (used on an exception, SIGTERM and exit)
+# A station whose relay lock is held too long (a stuck thread) is written anyway. Returns True if any relay was on
+def all_relays_off(reason):
+    was_on = False
+    for station in stations:
+        stop_station_jobs(station)
+        locked = station['relay_lock'].acquire(timeout=WATCHDOG_LOCK_TIMEOUT)
+        try:
+            if station['relay_state'] != station['all_off']:
+                was_on = True
+            for pin in station['relay_pins']:
+                pin.state = 1  #high - relay off (active low)
+            station['relay_state'] = station['all_off']
+            station['watchdog'] = [None] * PUMP_COUNT
+        finally:
+            if locked:
+                station['relay_lock'].release()
+    if was_on:
+        print('All relays off: ' + reason)
+    return was_on
+
+# An exception nobody caught on any thread turns the relays off before it is reported
+def watchdog_excepthook(hook_args):
+    all_relays_off('exception in thread ' + str(hook_args.thread.name if hook_args.thread else ''))
+    default_thread_excepthook(hook_args)
+
+def watchdog_sys_excepthook(exc_type, exc_value, exc_traceback):
+    all_relays_off('exception')
+    default_sys_excepthook(exc_type, exc_value, exc_traceback)
+
+# SIGTERM (systemd stop, kill) - relays off at once, then let the main loop end normally (saves the inventory and pour log)
+def watchdog_sigterm(signum, frame):
+    all_relays_off('SIGTERM')
+    if app is None:
+        sys.exit(128 + signum)
+    app.destroy()
+
+app = None  #the guizero App, once the UI is built
+default_thread_excepthook = threading.excepthook
+default_sys_excepthook = sys.excepthook
+threading.excepthook = watchdog_excepthook
+sys.excepthook = watchdog_sys_excepthook
+signal.signal(signal.SIGTERM, watchdog_sigterm)
+atexit.register(all_relays_off, 'exit')
+
+# Benchmark the skew between the first and last relay write when starting all of the first station's pumps,
+# old style (two LEDBoard writes per pump, pump by pump) vs the batched relay bank
+def relay_benchmark(rounds=2000):
+    import gc
+    station = stations[0]
+    relay = station['relay']
+    def old_drive_pump(pump_num, pump_action):
+        if pump_action == 'FORWARD':
+            relay[(pump_num * 2) - 2].off()
+            relay[(pump_num * 2) - 1].on()
+        else:
+            relay[(pump_num * 2) - 2].on()
+            relay[(pump_num * 2) - 1].on()
+
+    def measure(start_all, stop_all):
+        skews = []
+        gc.disable()  #keep garbage collection pauses out of the numbers
+        for i in range(rounds):
+            stop_all()
+            t = time.perf_counter()
+            start_all()
+            skews.append((time.perf_counter() - t) * 1000000)
+        gc.enable()
+        stop_all()
+        skews.sort()
+        return skews[len(skews) // 2], skews[int(len(skews) * 0.99)], skews[-1]
+
+    def old_all_forward():
+        for pump_num in range(1, PUMP_COUNT+1):
+            old_drive_pump(pump_num, 'FORWARD')
+
+    def old_all_off():
+        for pump_num in range(1, PUMP_COUNT+1):
+            old_drive_pump(pump_num, 'OFF')
+        station['relay_state'] = station['all_off']  #keep the bank in step with the pins we wrote behind its back
+
+    def batched_all_forward():
+        set_pumps(station, {pump_num: "FORWARD" for pump_num in range(1, PUMP_COUNT+1)})
+
+    def batched_all_off():
+        set_pumps(station, {pump_num: "OFF" for pump_num in range(1, PUMP_COUNT+1)})
+
+    print('Relay skew starting all ' + str(PUMP_COUNT) + ' pumps, ' + str(rounds) + ' rounds on ' + type(Device.pin_factory).__name__)
+    for label, start_all, stop_all in (('Per-pump writes', old_all_forward, old_all_off), ('Batched writes', batched_all_forward, batched_all_off)):
+        median, p99, worst = measure(start_all, stop_all)
+        print(format(label, '<18') + ' median ' + format(median, '8.1f') + ' us   p99 ' + format(p99, '8.1f') + ' us   max ' + format(worst, '8.1f') + ' us')
+
+if args.relay_bench:  #print the relay skew benchmark and quit
+    relay_benchmark()
+    sys.exit()
+
+# Simulator orders: a list of (seconds from start, drink name) for the chosen menu
+# From a file of "seconds,drink name" lines, or every drink on the menu at once if no file is given
+def load_sim_orders(path):
+    orders = []
+    if path == '':
+        for name in menus[chosen_menu_index]['DrinkNames']:
+            orders.append((0.0, name))
+    else:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line == '' or line.startswith('#'):
+                    continue
+                at, name = line.split(',', 1)
+                orders.append((float(at), name.strip()))
+    orders.sort(key=lambda order: order[0])
+    return orders
+
+# Simulator thread - "tap" the scripted orders into the pour queue on time, wait for them all to pour, then stop the app
+def simulator_feed(orders):
+    start = time.monotonic()
+    for at, name in orders:
+        delay = start + (at / SPEED) - time.monotonic()
+        if delay > 0:
+            sleep(delay)
+        rejected = queue_drink(name)
+        if rejected != '':
+            sim_rejected.append((at, name, rejected))
+    while len(sim_pours) + len(sim_rejected) < len(orders):
+        sleep(0.05)
+    app.destroy()
+
+# Print the simulation results (and write the relay transitions to CSV if asked)
+def print_sim_report(orders, elapsed, cpu):
+    lateness = sorted(step for stats in sim_pours for step in stats['lateness'])
+    transitions = 0
+    for t, station_index, old_state, new_state in relay_log:
+        transitions += bin(old_state ^ new_state).count('1')
+
+    print('Simulated ' + str(len(orders)) + ' orders from menu "' + menus[chosen_menu_index]['MenuName'] + '" at ' + str(SPEED) + 'x speed')
+    for stats in sim_pours:
+        line = '  ' + format(stats['drink'], '<30') + ' wait ' + format(stats['wait'], '6.2f') + ' s   pour ' + format(stats['time'], '6.2f') + ' s'
+        if len(stations) > 1:
+            line += '   ' + stations[stats['station']]['name']
+        print(line)
+    for at, name, reason in sim_rejected:
+        print('  ' + format(name, '<30') + ' rejected at ' + format(at, '.2f') + ' s: ' + reason)
+    if len(lateness) > 0:
+        print('Pump step lateness (ms): mean ' + format(sum(lateness) / len(lateness), '.3f') + '   p99 ' + format(lateness[int(len(lateness) * 0.99)], '.3f') + '   max ' + format(lateness[-1], '.3f'))
+    if elapsed > 0:
+        print('Throughput: ' + format(len(sim_pours) * 3600 / (elapsed * SPEED), '.1f') + ' drinks/hour (real-time equivalent)')
+        print('CPU: ' + format(cpu, '.2f') + ' s over ' + format(elapsed, '.2f') + ' s (' + format(cpu * 100 / elapsed, '.1f') + '%)')
+    print('Relay transitions: ' + str(transitions))
+    trips = len([record for record in watchdog_records if record['tripped']])
+    print('Watchdog: ' + str(trips) + ' trips, ' + str(len(watchdog_records) - trips) + ' near misses')
+
+    if args.relay_log:
+        with open(args.relay_log, 'w') as f:
+            f.write('seconds,station,relay,level\n')
+            for t, station_index, old_state, new_state in relay_log:
+                changed = old_state ^ new_state
+                for n in range(PUMP_COUNT * 2):
+                    if (changed >> n) & 1:
+                        f.write(format(t - sim_start, '.6f') + ',' + stations[station_index]['name'] + ',' + str(n) + ',' + str((new_state >> n) & 1) + '\n')
+
+
+# Local HTTP/JSON order API - runs an asyncio server on its own thread so staff tablets / queue displays can order
+#   GET    /menus          all menus with their bottles and drinks
+#   GET    /menus/<n>      one menu
+#   GET    /queue          the drinks pouring now and the orders waiting, overall and by station
+#   POST   /orders         {"drink": "SCREWDRIVER", "menu": 0 or "Pool Party" (optional, default the chosen menu)}
+#   DELETE /orders/last    cancel the most recently queued order
+#   DELETE /orders/<n>     cancel the waiting order at position n of /queue's "queued" list (0 = the next to pour)
+#   GET    /events         server-sent events: pumps, pour, progress, pour_done, queue, maintenance and watchdog
+# Web pages on the bar's network must not be able to pour: POST bodies have to be sent as application/json (a browser
+# asks first - a CORS preflight - and only --api-origin is let through), and with --api-token every request needs the token
+API_EVENT_BACKLOG = 100     #events kept for a slow /events client before the oldest are dropped
+api_loop = None
+api_event_queues = set()    #one asyncio.Queue per connected /events client
+
+# Is the request allowed? Returns None if so, otherwise the (HTTP status, JSON-able result) to answer with
+def api_check(method, headers, query):
+    if args.api_token:
+        token = headers.get('authorization', '')
+        if token.lower().startswith('bearer '):
+            token = token[7:].strip()
+        else:
+            token = parse_qs(query).get('token', [''])[0]  #a browser EventSource can't send headers
+        if not hmac.compare_digest(token.encode(), args.api_token.encode()):
+            return 401, {'error': 'Missing or wrong API token'}
+    if method == 'POST' and headers.get('content-type', '').split(';')[0].strip().lower() != 'application/json':
+        return 415, {'error': 'Content-Type must be application/json'}
+    return None
+
+# CORS headers - only the configured --api-origin may read the API from a browser
+def api_cors_headers():
+    if not args.api_origin:
+        return ''
+    return 'Access-Control-Allow-Origin: ' + args.api_origin + '\r\nVary: Origin\r\n'
+
+def api_menu(index):
+    m = menus[index]
+    return {'index': index, 'MenuName': m['MenuName'], 'Bottles': m['Bottles'],
+            'Drinks': [{'Name': name, 'Recipe': m['Recipes'][name], 'CanPour': any(can_pour(station, index, name) for station in stations)} for name in m['DrinkNames']]}
+
+# Handle one API request (on the API thread). Returns (HTTP status, JSON-able result)
+def api_route(method, path, body):
+    parts = [part for part in path.split('/') if part != '']
+    if method == 'GET' and parts == ['menus']:
+        return 200, {'chosen': chosen_menu_index, 'menus': [api_menu(x) for x in range(len(menus))]}
+    if method == 'GET' and len(parts) == 2 and parts[0] == 'menus':
+        if parts[1].isdigit() and int(parts[1]) < len(menus):
+            return 200, api_menu(int(parts[1]))
+        return 404, {'error': 'No such menu'}
+    if method == 'GET' and parts == ['queue']:
+        return 200, queue_status()
+    if method == 'POST' and parts == ['orders']:
+        try:
+            order = json.loads(body or b'{}')
+            value = order['drink']
+        except (ValueError, KeyError, TypeError):
+            return 400, {'error': 'Expected {"drink": name}'}
+        order_menu_index = order.get('menu', chosen_menu_index)
+        if not isinstance(value, str) or isinstance(order_menu_index, bool) or not isinstance(order_menu_index, (int, str)):
+            return 400, {'error': 'Expected {"drink": name, "menu": index or name}'}
+        if not isinstance(order_menu_index, int):
+            names = [m['MenuName'] for m in menus]
+            if order_menu_index not in names:
+                return 404, {'error': 'No such menu'}
+            order_menu_index = names.index(order_menu_index)
+        if not 0 <= order_menu_index < len(menus):
+            return 404, {'error': 'No such menu'}
+        rejected = queue_drink(value, order_menu_index, tapped=False)
+        if rejected != '':
+            return 409, {'error': rejected}
+        return 202, queue_status()
+    if method == 'DELETE' and parts == ['orders', 'last']:
+        cancel_queued_drink()
+        return 200, queue_status()
+    if method == 'DELETE' and len(parts) == 2 and parts[0] == 'orders':
+        if parts[1].isdigit() and cancel_queued_drink(int(parts[1])):
+            return 200, queue_status()
+        return 404, {'error': 'No such order'}
+    return 404, {'error': 'Not found'}
+
+async def api_send(writer, status, result):
+    body = json.dumps(result).encode()
+    reasons = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found', 409: 'Conflict', 415: 'Unsupported Media Type'}
+    writer.write(('HTTP/1.1 ' + str(status) + ' ' + reasons.get(status, '') + '\r\n'
+                  'Content-Type: application/json\r\nContent-Length: ' + str(len(body)) + '\r\n' +
+                  api_cors_headers() + 'Connection: close\r\n\r\n').encode() + body)
+    await writer.drain()
+
+async def api_handle(reader, writer):
+    try:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) < 2:
+            return
+        method = request_line[0]
+        path, sep, query = request_line[1].partition('?')
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, sep, header_value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = header_value.strip()
+        body = b''
+        length = int(headers.get('content-length', '0') or 0)
+        if 0 < length <= 65536:
+            body = await reader.readexactly(length)
+        if method == 'OPTIONS' and args.api_origin:  #CORS preflight from the allowed origin's page
+            writer.write(('HTTP/1.1 204 No Content\r\n' + api_cors_headers() +
+                          'Access-Control-Allow-Methods: GET, POST, DELETE\r\nAccess-Control-Allow-Headers: Content-Type, Authorization\r\n'
+                          'Access-Control-Max-Age: 600\r\nConnection: close\r\n\r\n').encode())
+            await writer.drain()
+            return
+        refused = api_check(method, headers, query)
+        if refused is not None:
+            await api_send(writer, *refused)
+        elif method == 'GET' and path == '/events':
+            await api_events(writer)
+        else:
+            status, result = api_route(method, path, body)
+            await api_send(writer, status, result)
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+# Stream events to one client until it goes away (a comment every 15s keeps the connection alive)
+async def api_events(writer):
+    events = asyncio.Queue(API_EVENT_BACKLOG)
+    for station in stations:
+        events.put_nowait(('pumps', {'station': station['name'], 'pumps': pump_states(station['relay_state'])}))
+    events.put_nowait(('queue', queue_status()))
+    api_event_queues.add(events)
+    try:
+        writer.write(('HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n' + api_cors_headers() + '\r\n').encode())
+        while True:
+            try:
+                kind, data = await asyncio.wait_for(events.get(), 15)
+                writer.write(('event: ' + kind + '\ndata: ' + json.dumps(data) + '\n\n').encode())
+            except asyncio.TimeoutError:
+                writer.write(b': keepalive\n\n')
+            await writer.drain()
+    finally:
+        api_event_queues.discard(events)
+
+# Event listener (called on the pour thread) - hand the event to the API loop, never wait on a client
+def api_event_listener(kind, data):
+    api_loop.call_soon_threadsafe(api_fan_out, kind, data)
+
+def api_fan_out(kind, data):
+    for events in api_event_queues:
+        if events.full():
+            events.get_nowait()  #slow client - drop its oldest event
+        events.put_nowait((kind, data))
+
+def api_thread(port):
+    global api_loop
+    api_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(api_loop)
+    api_loop.run_until_complete(asyncio.start_server(api_handle, '0.0.0.0', port))
+    subscribe_events(api_event_listener)
+    print('Order API on port ' + str(port))
+    api_loop.run_forever()
+
+
+# Pour display - the banner, and a progress bar and pump lights for each station on the Main screen
+# Events from the pour thread only update ui_state. refresh_pour_display() runs on the UI thread every UI_REFRESH_MS
+# and draws whatever has changed, so the refresh rate stays fixed however many events come in and drawing never
+# holds up the pumps. The progress bar is worked out from the pour's start time, so it moves smoothly between events
+UI_REFRESH_MS = 100
+PROGRESS_WIDTH = 900        #pixels
+PUMP_LIGHT_COLORS = {'FORWARD': "#009900", 'REVERSE': "#0099ff", 'OFF': "#cccccc"} #green, blue, grey
+ui_state_lock = threading.Lock()
+ui_state = {'pumps': {}, 'pours': {}, 'pour_done': False, 'queue': False, 'calibration': None,
+            'maintenance': None, 'maintenance_start': 0, 'watchdog': None}  #pumps and pours (pour event, start time) by station index
+pump_lights_shown = [[None] * PUMP_COUNT for station in stations]
+progress_shown = [0] * len(stations)
+
+def ui_event_listener(kind, data):
+    with ui_state_lock:
+        if kind == 'pumps':
+            ui_state['pumps'][station_by_name[data['station']]['index']] = data['pumps']
+        elif kind == 'pour':
+            ui_state['pours'][station_by_name[data['station']]['index']] = (data, time.monotonic())
+        elif kind == 'pour_done':
+            ui_state['pours'].pop(station_by_name[data['station']]['index'], None)
+            ui_state['pour_done'] = True
+        elif kind == 'queue':
+            ui_state['queue'] = True
+        elif kind == 'calibration':
+            ui_state['calibration'] = data
+        elif kind == 'watchdog' and data['tripped']:
+            ui_state['watchdog'] = data
+        elif kind == 'maintenance':
+            ui_state['maintenance'] = data
+            if data['running']:
+                ui_state['maintenance_start'] = time.monotonic()
+
+def refresh_pour_display():
+    global queue_message_until
+    with ui_state_lock:
+        pumps = ui_state['pumps']
+        ui_state['pumps'] = {}
+        pours = dict(ui_state['pours'])
+        pour_done = ui_state['pour_done']
+        queue_changed = ui_state['queue']
+        calibration_status = ui_state['calibration']
+        watchdog_trip = ui_state['watchdog']
+        ui_state['watchdog'] = None
+        maintenance_status = ui_state['maintenance']
+        maintenance_start = ui_state['maintenance_start']
+        ui_state['pour_done'] = False
+        ui_state['queue'] = False
+        ui_state['calibration'] = None
+
+    for station_index, station_pumps in pumps.items():
+        lights_shown = pump_lights_shown[station_index]
+        for x in range(PUMP_COUNT):
+            if station_pumps[x] != lights_shown[x]:  #only touch the lights that changed
+                pump_lights[station_index][x].bg = PUMP_LIGHT_COLORS[station_pumps[x]]
+                lights_shown[x] = station_pumps[x]
+
+    if len(pours) > 0:
+        drinks = ", ".join(pours[station_index][0]['drink'] for station_index in sorted(pours))
+        if drink_pour_text.value != drinks:
+            drink_pour_label.value = "       Pouring a: " #announce what's being poured at the bottom banner
+            drink_pour_text.value = drinks
+    elif drink_pour_text.value != "":
+        drink_pour_label.clear() #clear the drink bottom banner
+        drink_pour_text.clear()
+    for station_index in range(len(stations)):
+        progress = 0
+        if station_index in pours:
+            pour, pour_start = pours[station_index]
+            if pour['total_ms'] > 0:
+                progress = int(PROGRESS_WIDTH * min(1.0, (time.monotonic() - pour_start) * 1000 / pour['total_ms']))
+        if progress != progress_shown[station_index]:
+            pour_progress[station_index].clear()
+            if progress > 0:
+                pour_progress[station_index].rectangle(0, 0, progress, 12, color="red")
+            progress_shown[station_index] = progress
+
+    if pour_done:
+        update_inventory_display()
+    if watchdog_trip is not None:
+        update_queue_text("Watchdog stopped pump " + str(watchdog_trip['pump']))
+    elif queue_changed or (queue_message_until != 0 and time.monotonic() >= queue_message_until):
+        if time.monotonic() >= queue_message_until:
+            queue_message_until = 0
+        update_queue_text()
+    if queue_changed and window_queue_panel is not None:
+        update_queue_panel()
+    if calibration_status is not None and window_control_panel is not None:
+        calibration_text.value = calibration_status['text']
+        button_calibrate_run.enabled = not calibration_status['running']
+    if maintenance_status is not None and window_control_panel is not None:
+        if maintenance_status['running']:
+            elapsed_ms = min((time.monotonic() - maintenance_start) * 1000, maintenance_status['total_ms'])
+            text = maintenance_status['program'] + " running " + str(int(elapsed_ms / 1000)) + " / " + str(int(maintenance_status['total_ms'] / 1000)) + " s"
+        else:
+            text = maintenance_status['text']
+        if len(stations) > 1:
+            text = maintenance_status['station'] + ": " + text
+        if maintenance_text.value != text:  #only redraw when the whole seconds change
+            maintenance_text.value = text
 
 
 ####################################################################
@@ -256,228 +2518,312 @@ menu_right_margin_box = Box(window_main_menu_panel, layout="auto", width=45, hei
 
 message = Text(window_main_menu_panel, text="", size=10)  # vertical spacing
 message = Text(window_main_menu_panel, text="iDrink - Please Tap to Pour!", size=35)
-message = Text(window_main_menu_panel, text="", size=10)  # vertical spacing
+inventory_warning_text = Text(window_main_menu_panel, text="", size=16, color="red")
 
 main_buttons_box = Box(window_main_menu_panel, layout="auto", width="fill", align="bottom")
+
+# Pour progress bar and a light for each pump (green forward, blue reverse), a row for each station
+pump_lights = [None] * len(stations)
+pour_progress = [None] * len(stations)
+for station in reversed(stations):  #rows are packed bottom up, so the first station ends up on top
+    pour_status_box = Box(window_main_menu_panel, layout="auto", width="fill", align="bottom")
+    if len(stations) > 1:
+        message = Text(pour_status_box, text=station['name'], size=14, width=8, align="left")
+    lights = []
+    for x in range(PUMP_COUNT):
+        lights.append(Text(pour_status_box, text=str(x+1), size=14, width=3, align="left"))
+        lights[x].bg = PUMP_LIGHT_COLORS['OFF']
+    pump_lights[station['index']] = lights
+    pour_progress[station['index']] = Drawing(pour_status_box, width=PROGRESS_WIDTH, height=12, align="left")
+
 main_drinks_list = ListBox(window_main_menu_panel, command=thread_function, width="fill", height="fill", scrollbar=True, align="top")
 main_drinks_list.bg="white"
+main_drinks_list.text_size = "30"
+main_drinks_list.text_color = "blue"
 
 message = Text(main_buttons_box, text="", size=10)  # vertical spacing
 button_menu = PushButton(main_buttons_box, command=enter_menu_panel, align="left", width="10", height="2", text="Menus")
 button_control = PushButton(main_buttons_box, command=enter_control_panel, align="left", width="10",height="2", text="Control")
+button_tweak = PushButton(main_buttons_box, command=arm_tweak, align="left", width="10", height="2", text="Tweak")
 drink_pour_label = Text(main_buttons_box, text="", size="25", align="left")
 drink_pour_text = Text(main_buttons_box, text="", size="25", align="left", color="red")
+drink_queue_text = Text(main_buttons_box, text="", size="20", align="left")
+button_cancel_queued = PushButton(main_buttons_box, command=enter_queue_panel, align="right", width="10", height="2", text="Queue")
+button_cancel_queued.enabled = False
 
 button_menu.bg="#cccccc" #grey
 button_control.bg="#cccccc" #grey
-
-update_main_panel()
+button_tweak.bg="#cccccc" #grey
+button_cancel_queued.bg="#cccccc" #grey
 
 ############################
 #Menu Selection Panel layout
 ############################
-window_menu_select_panel = Window(app, title="iDrink Menu selection screen", bg="white", height="600", width="1024")
-window_menu_select_panel.set_full_screen()
-window_menu_select_panel.bg = "#b3ffb3" #green
-window_menu_select_panel.hide()
+# The Menu selection and Control Panel screens are built the first time they are opened (keeps startup fast)
+window_menu_select_panel = None
+window_control_panel = None
+window_tweak_panel = None
+window_queue_panel = None
+
+def build_menu_select_panel():
+    global window_menu_select_panel, message_menu1, message_menu3, message_menu_plan, menu_menu_drink_list, button_prev_menu, button_next_menu
+    window_menu_select_panel = Window(app, title="iDrink Menu selection screen", bg="white", height="600", width="1024")
+    window_menu_select_panel.set_full_screen()
+    window_menu_select_panel.bg = "#b3ffb3" #green
+    window_menu_select_panel.hide()
 
-# set screen left and right margins
-menu_left_margin_box = Box(window_menu_select_panel, layout="auto", width=45, height="fill", align="left")
-menu_right_margin_box = Box(window_menu_select_panel, layout="auto", width=45, height="fill", align="right")
-
-message = Text(window_menu_select_panel, text="", size=10)  # vertical spacing
-message = Text(window_menu_select_panel, text="iDrink Bar Menus", size=35)
-message = Text(window_menu_select_panel, text="", size=10)  # vertical spacing
-
-menu_name_box = Box(window_menu_select_panel, layout="auto", width="fill", align="top")
-menu_name_box.bg="#bfbfbf" #grey
-menu_bottles_box = Box(window_menu_select_panel, layout="grid", width="fill", align="top")
-menu_bottles_box.bg="#bfbfbf" #grey
-menu_drinks_box = Box(window_menu_select_panel, layout="auto", width="fill", align="top")
-menu_drinks_box.bg="white"
-
-# print Menu name
-message_menu1 = TextBox(menu_name_box, text=menu_json['Menu'][menu_index]['MenuName'], width="fill", align="top")
-#print the Bottles used in this Menu
-message_menu2 = Text(menu_bottles_box, text="Bottles: ", width="fill", grid=[0, 0])
-message_menu3 = TextBox(menu_bottles_box, text=menu_json['Menu'][menu_index]['Bottles'], width="fill", multiline=True, grid=[1, 0])
-menu_menu_drink_list = TextBox(menu_drinks_box, text="Drinks:", width="fill", height="8", multiline=True, scrollbar=True, align="top")
-
-message_menu1.font = "helvetica"
-message_menu2.font = "helvetica"
-message_menu3.font = "helvetica"
-message_menu1.text_size = "30"
-message_menu2.text_size = "25"
-message_menu3.text_size = "15"
-
-menu_buttons_box = Box(window_menu_select_panel, layout="auto", width="fill", align="bottom")
-button_prev_menu = PushButton(menu_buttons_box, command=prev_menu, align="left", width="15", height="2", text="Prev")
-button_next_menu = PushButton(menu_buttons_box, command=next_menu, align="left", width="15",height="2", text="Next")
-button_select = PushButton(menu_buttons_box, command=select_menu, align="left", width="15", height="2", text="Select")
-button_cancel = PushButton(menu_buttons_box, command=enter_main_panel, align="left", width="15", height="2", text="Cancel")
-button_prev_menu.bg="#cccccc" #grey
-button_next_menu.bg="#cccccc" #grey
-button_select.bg="#cccccc" #grey
-button_cancel.bg="#cccccc" #grey
-
-update_menu_panel()
+    # set screen left and right margins
+    menu_left_margin_box = Box(window_menu_select_panel, layout="auto", width=45, height="fill", align="left")
+    menu_right_margin_box = Box(window_menu_select_panel, layout="auto", width=45, height="fill", align="right")
+
+    message = Text(window_menu_select_panel, text="", size=10)  # vertical spacing
+    message = Text(window_menu_select_panel, text="iDrink Bar Menus", size=35)
+    message = Text(window_menu_select_panel, text="", size=10)  # vertical spacing
+
+    menu_name_box = Box(window_menu_select_panel, layout="auto", width="fill", align="top")
+    menu_name_box.bg="#bfbfbf" #grey
+    menu_bottles_box = Box(window_menu_select_panel, layout="grid", width="fill", align="top")
+    menu_bottles_box.bg="#bfbfbf" #grey
+    message_menu_plan = Text(window_menu_select_panel, text="", size=16, color="red", align="top")  #bottles to move for this menu
+    menu_drinks_box = Box(window_menu_select_panel, layout="auto", width="fill", align="top")
+    menu_drinks_box.bg="white"
+
+    # print Menu name
+    message_menu1 = TextBox(menu_name_box, text=menus[menu_index]['MenuName'], width="fill", align="top")
+    #print the Bottles used in this Menu
+    message_menu2 = Text(menu_bottles_box, text="Bottles: ", width="fill", grid=[0, 0])
+    message_menu3 = TextBox(menu_bottles_box, text=menus[menu_index]['Bottles'], width="fill", multiline=True, grid=[1, 0])
+    menu_menu_drink_list = TextBox(menu_drinks_box, text="Drinks:", width="fill", height="8", multiline=True, scrollbar=True, align="top")
+    menu_menu_drink_list.font = "helvetica"
+    menu_menu_drink_list.text_size = "25"
+    menu_menu_drink_list.text_color = "red"
+
+    message_menu1.font = "helvetica"
+    message_menu2.font = "helvetica"
+    message_menu3.font = "helvetica"
+    message_menu1.text_size = "30"
+    message_menu2.text_size = "25"
+    message_menu3.text_size = "15"
+
+    menu_buttons_box = Box(window_menu_select_panel, layout="auto", width="fill", align="bottom")
+    button_prev_menu = PushButton(menu_buttons_box, command=prev_menu, align="left", width="15", height="2", text="Prev")
+    button_next_menu = PushButton(menu_buttons_box, command=next_menu, align="left", width="15",height="2", text="Next")
+    button_select = PushButton(menu_buttons_box, command=select_menu, align="left", width="15", height="2", text="Select")
+    button_cancel = PushButton(menu_buttons_box, command=enter_main_panel, align="left", width="15", height="2", text="Cancel")
+    for button in (button_prev_menu, button_next_menu, button_select, button_cancel):
+        button.bg="#cccccc" #grey
 
 #############################
 # Control Panel screen layout
 #############################
-window_control_panel = Window(app, title="iDrink Control Panel", bg="white", height="600", width="1024")
-window_control_panel.set_full_screen()
-window_control_panel.hide()
+# A row of 8 buttons, one per pump
+# Note: button.bg property does not work on the MacOS
+def pump_button_row(box, pump_action, text, color):
+    for pump_num in range(1, PUMP_COUNT+1):
+        button = PushButton(box, command=drive_pump, args=[pump_num, pump_action], width=7, height=1, align="left", text=text)
+        button.text_color="white"
+        button.bg=color
+        button.text_size="16"
+
+def build_control_panel():
+    global window_control_panel, calibration_pump, calibration_volume, calibration_text, button_calibrate_run
+    global inventory_pump, inventory_levels_text, maintenance_text, control_station_combo
+    window_control_panel = Window(app, title="iDrink Control Panel", bg="white", height="600", width="1024")
+    window_control_panel.set_full_screen()
+    window_control_panel.hide()
 
-message = Text(window_control_panel, text="", size=10) # vertical spacing
-message = Text(window_control_panel, text="iDrink Control Panel", size=30)
-message = Text(window_control_panel, text="", size=10) #vertical spacing
+    message = Text(window_control_panel, text="", size=10) # vertical spacing
+    message = Text(window_control_panel, text="iDrink Control Panel", size=30)
+    message = Text(window_control_panel, text="", size=10) #vertical spacing
+
+    # set screen left and right margins
+    control_left_margin_box = Box(window_control_panel, layout="auto", width=45, height="fill", align="left")
+    control_right_margin_box = Box(window_control_panel, layout="auto", width=45, height="fill", align="right")
+
+    # Station the panel works on (the pump buttons, calibration, bottles and line programs - ALL OFF stops every station)
+    if len(stations) > 1:
+        station_box = Box(window_control_panel, layout="auto", width="fill", align="top")
+        message = Text(station_box, text="Station ", size=16, align="left")
+        control_station_combo = Combo(station_box, options=[station['name'] for station in stations], command=select_control_station, align="left")
+        control_station_combo.text_size="16"
+
+    Pump_Label_box = Box(window_control_panel, layout="auto", width="fill", align="top")
+    for pump_num in range(1, PUMP_COUNT+1):
+        message = Text(Pump_Label_box, text=str(pump_num), size=22, align="left", width="7")
+
+    # Pump forward, reverse and off buttons
+    Pump_Forward_buttons_box = Box(window_control_panel, layout="auto", width="fill", align="top")
+    pump_button_row(Pump_Forward_buttons_box, "FORWARD", "F", "#009900") #green
+    Pump_Reverse_buttons_box = Box(window_control_panel, layout="auto", width="fill", align="top")
+    pump_button_row(Pump_Reverse_buttons_box, "REVERSE", "R", "#0099ff") #blue
+    pump_off_buttons_box = Box(window_control_panel, layout="auto", width="fill", align="top")
+    pump_button_row(pump_off_buttons_box, "OFF", "OFF", "red")
+
+    pump_options = [str(pump_num) for pump_num in range(1, PUMP_COUNT+1)]
+
+    # Pump calibration row
+    calibration_box = Box(window_control_panel, layout="auto", width="fill", align="top")
+    message = Text(calibration_box, text="Calibrate pump ", size=16, align="left")
+    calibration_pump = Combo(calibration_box, options=pump_options, command=update_calibration_text, align="left")
+    button_calibrate_run = PushButton(calibration_box, command=run_calibration, align="left", width=7, height=1, text="Run " + str(CALIBRATION_RUN_MS // 1000) + "s")
+    message = Text(calibration_box, text=" Poured (oz): ", size=16, align="left")
+    calibration_volume = TextBox(calibration_box, width=6, align="left")
+    button_calibrate_save = PushButton(calibration_box, command=save_calibration_volume, align="left", width=7, height=1, text="Save")
+    calibration_text = Text(calibration_box, text="", size=14, align="left")
+
+    # Bottle inventory row
+    inventory_box = Box(window_control_panel, layout="auto", width="fill", align="top")
+    message = Text(inventory_box, text="Bottle on pump ", size=16, align="left")
+    inventory_pump = Combo(inventory_box, options=pump_options, align="left")
+    button_refill = PushButton(inventory_box, command=refill_selected_bottle, align="left", width=7, height=1, text="Refill")
+    button_refill_all = PushButton(inventory_box, command=refill_all_bottles, align="left", width=9, height=1, text="Refill All")
+    inventory_levels_text = Text(inventory_box, text="", size=12, align="left")
+
+    # Maintenance programs row (ALL OFF cancels)
+    maintenance_box = Box(window_control_panel, layout="auto", width="fill", align="top")
+    message = Text(maintenance_box, text="Lines ", size=16, align="left")
+    maintenance_buttons = []
+    for name in MAINTENANCE_PROGRAMS:
+        maintenance_buttons.append(PushButton(maintenance_box, command=maintenance_button, args=[name], align="left", width=7, height=1, text=name))
+    maintenance_text = Text(maintenance_box, text="", size=14, align="left")
+
+    for widget in [calibration_pump, calibration_volume, button_calibrate_run, button_calibrate_save, inventory_pump, button_refill, button_refill_all] + maintenance_buttons:
+        widget.text_size="16"
+    for button in [button_calibrate_run, button_calibrate_save, button_refill, button_refill_all] + maintenance_buttons:
+        button.bg="#cccccc" #grey
+
+    pump_all_margin_left_box = Box(window_control_panel, layout="auto", width="200", align="left")
+    pump_all_margin_right_box = Box(window_control_panel, layout="auto", width="200", align="right")
+    pump_all_buttons_box = Box(window_control_panel, layout="auto", width="fill", align="top")
+
+    button_all_forward = PushButton(pump_all_buttons_box, command=all_pumps_forward, align="top", width="fill", height="2", text="ALL FORWARD")
+    button_all_reverse = PushButton(pump_all_buttons_box, command=all_pumps_reverse, align="top", width="fill", height="2", text="ALL REVERSE")
+    button_all_off = PushButton(pump_all_buttons_box, command=all_pumps_off, align="top", width="fill", height="2", text="ALL OFF")
+    button_exit = PushButton(pump_all_buttons_box, command=enter_main_panel, align="top", width="fill", height="2", text="EXIT")
+
+    for button in (button_all_forward, button_all_reverse, button_all_off, button_exit):
+        button.text_size="14"
+    for button in (button_all_forward, button_all_reverse, button_all_off):
+        button.text_color="white"
+    button_all_forward.bg="#009900" #green
+    button_all_reverse.bg="#0099ff" #blue
+    button_all_off.bg="red"
+    button_exit.bg="#808080" #grey
+
+    update_calibration_text()
 
-# set screen left and right margins
-control_left_margin_box = Box(window_control_panel, layout="auto", width=45, height="fill", align="left")
-control_right_margin_box = Box(window_control_panel, layout="auto", width=45, height="fill", align="right")
-
-Pump_Label_box = Box(window_control_panel, layout="auto", width="fill", align="top")
-message = Text(Pump_Label_box, text="1", size=22, align="left", width="7")
-message = Text(Pump_Label_box, text="2", size=22, align="left", width="7")
-message = Text(Pump_Label_box, text="3", size=22, align="left", width="7")
-message = Text(Pump_Label_box, text="4", size=22, align="left", width="7")
-message = Text(Pump_Label_box, text="5", size=22, align="left", width="7")
-message = Text(Pump_Label_box, text="6", size=22, align="left", width="7")
-message = Text(Pump_Label_box, text="7", size=22, align="left", width="7")
-message = Text(Pump_Label_box, text="8", size=22, align="left", width="7")
-
-# Pump forward buttons
-#message = Text(left_margin_box, text="F", size=30)
-Pump_Forward_buttons_box = Box(window_control_panel, layout="auto", width="fill", align="top")
-button_Pump_Forward_1 = PushButton(Pump_Forward_buttons_box, command=drive_pump, args=[1,"FORWARD"], width=7, height=1, align="left", text="F")
-button_Pump_Forward_2 = PushButton(Pump_Forward_buttons_box, command=drive_pump, args=[2,"FORWARD"], width=7, height=1, align="left", text="F")
-button_Pump_Forward_3 = PushButton(Pump_Forward_buttons_box, command=drive_pump, args=[3,"FORWARD"], width=7, height=1, align="left", text="F")
-button_Pump_Forward_4 = PushButton(Pump_Forward_buttons_box, command=drive_pump, args=[4,"FORWARD"], width=7, height=1, align="left", text="F")
-button_Pump_Forward_5 = PushButton(Pump_Forward_buttons_box, command=drive_pump, args=[5,"FORWARD"], width=7, height=1, align="left", text="F")
-button_Pump_Forward_6 = PushButton(Pump_Forward_buttons_box, command=drive_pump, args=[6,"FORWARD"], width=7, height=1, align="left", text="F")
-button_Pump_Forward_7 = PushButton(Pump_Forward_buttons_box, command=drive_pump, args=[7,"FORWARD"], width=7, height=1, align="left", text="F")
-button_Pump_Forward_8 = PushButton(Pump_Forward_buttons_box, command=drive_pump, args=[8,"FORWARD"], width=7, height=1, align="left", text="F")
-button_Pump_Forward_1.text_color="white"
-button_Pump_Forward_2.text_color="white"
-button_Pump_Forward_3.text_color="white"
-button_Pump_Forward_4.text_color="white"
-button_Pump_Forward_5.text_color="white"
-button_Pump_Forward_6.text_color="white"
-button_Pump_Forward_7.text_color="white"
-button_Pump_Forward_8.text_color="white"
-# Note: button.bg property does not work on the MacOS
-button_Pump_Forward_1.bg="#009900" #green
-button_Pump_Forward_2.bg="#009900"
-button_Pump_Forward_3.bg="#009900"
-button_Pump_Forward_4.bg="#009900"
-button_Pump_Forward_5.bg="#009900"
-button_Pump_Forward_6.bg="#009900"
-button_Pump_Forward_7.bg="#009900"
-button_Pump_Forward_8.bg="#009900"
-button_Pump_Forward_1.text_size="16"
-button_Pump_Forward_2.text_size="16"
-button_Pump_Forward_3.text_size="16"
-button_Pump_Forward_4.text_size="16"
-button_Pump_Forward_5.text_size="16"
-button_Pump_Forward_6.text_size="16"
-button_Pump_Forward_7.text_size="16"
-button_Pump_Forward_8.text_size="16"
-
-# Pump reverse buttons
-#message = Text(left_margin_box, text="R", size=30)
-Pump_Reverse_buttons_box = Box(window_control_panel, layout="auto", width="fill", align="top")
-button_Pump_Reverse_1 = PushButton(Pump_Reverse_buttons_box, command=drive_pump, args=[1,"REVERSE"], width=7, height=1, align="left", text="R")
-button_Pump_Reverse_2 = PushButton(Pump_Reverse_buttons_box, command=drive_pump, args=[2,"REVERSE"], width=7, height=1, align="left", text="R")
-button_Pump_Reverse_3 = PushButton(Pump_Reverse_buttons_box, command=drive_pump, args=[3,"REVERSE"], width=7, height=1, align="left", text="R")
-button_Pump_Reverse_4 = PushButton(Pump_Reverse_buttons_box, command=drive_pump, args=[4,"REVERSE"], width=7, height=1, align="left", text="R")
-button_Pump_Reverse_5 = PushButton(Pump_Reverse_buttons_box, command=drive_pump, args=[5,"REVERSE"], width=7, height=1, align="left", text="R")
-button_Pump_Reverse_6 = PushButton(Pump_Reverse_buttons_box, command=drive_pump, args=[6,"REVERSE"], width=7, height=1, align="left", text="R")
-button_Pump_Reverse_7 = PushButton(Pump_Reverse_buttons_box, command=drive_pump, args=[7,"REVERSE"], width=7, height=1, align="left", text="R")
-button_Pump_Reverse_8 = PushButton(Pump_Reverse_buttons_box, command=drive_pump, args=[8,"REVERSE"], width=7, height=1, align="left", text="R")
-button_Pump_Reverse_1.text_color="white"
-button_Pump_Reverse_2.text_color="white"
-button_Pump_Reverse_3.text_color="white"
-button_Pump_Reverse_4.text_color="white"
-button_Pump_Reverse_5.text_color="white"
-button_Pump_Reverse_6.text_color="white"
-button_Pump_Reverse_7.text_color="white"
-button_Pump_Reverse_8.text_color="white"
-# Note, button.bg property does not work on the MacOS
-button_Pump_Reverse_1.bg="#0099ff" #blue
-button_Pump_Reverse_2.bg="#0099ff"
-button_Pump_Reverse_3.bg="#0099ff"
-button_Pump_Reverse_4.bg="#0099ff"
-button_Pump_Reverse_5.bg="#0099ff"
-button_Pump_Reverse_6.bg="#0099ff"
-button_Pump_Reverse_7.bg="#0099ff"
-button_Pump_Reverse_8.bg="#0099ff"
-button_Pump_Reverse_1.text_size="16"
-button_Pump_Reverse_2.text_size="16"
-button_Pump_Reverse_3.text_size="16"
-button_Pump_Reverse_4.text_size="16"
-button_Pump_Reverse_5.text_size="16"
-button_Pump_Reverse_6.text_size="16"
-button_Pump_Reverse_7.text_size="16"
-button_Pump_Reverse_8.text_size="16"
-
-# Pump Off buttons
-pump_off_buttons_box = Box(window_control_panel, layout="auto", width="fill", align="top")
-button_Pump_Off_1 = PushButton(pump_off_buttons_box, command=drive_pump, args=[1,"OFF"], width=7, height=1, align="left", text="OFF")
-button_Pump_Off_2 = PushButton(pump_off_buttons_box, command=drive_pump, args=[2,"OFF"], width=7, height=1, align="left", text="OFF")
-button_Pump_Off_3 = PushButton(pump_off_buttons_box, command=drive_pump, args=[3,"OFF"], width=7, height=1, align="left", text="OFF")
-button_Pump_Off_4 = PushButton(pump_off_buttons_box, command=drive_pump, args=[4,"OFF"], width=7, height=1, align="left", text="OFF")
-button_Pump_Off_5 = PushButton(pump_off_buttons_box, command=drive_pump, args=[5,"OFF"], width=7, height=1, align="left", text="OFF")
-button_Pump_Off_6 = PushButton(pump_off_buttons_box, command=drive_pump, args=[6,"OFF"], width=7, height=1, align="left", text="OFF")
-button_Pump_Off_7 = PushButton(pump_off_buttons_box, command=drive_pump, args=[7,"OFF"], width=7, height=1, align="left", text="OFF")
-button_Pump_Off_8 = PushButton(pump_off_buttons_box, command=drive_pump, args=[8,"OFF"], width=7, height=1, align="left", text="OFF")
-button_Pump_Off_1.text_color="white"
-button_Pump_Off_2.text_color="white"
-button_Pump_Off_3.text_color="white"
-button_Pump_Off_4.text_color="white"
-button_Pump_Off_5.text_color="white"
-button_Pump_Off_6.text_color="white"
-button_Pump_Off_7.text_color="white"
-button_Pump_Off_8.text_color="white"
-# Note: button.bg property does not work on the MacOS
-button_Pump_Off_1.bg="red"
-button_Pump_Off_2.bg="red"
-button_Pump_Off_3.bg="red"
-button_Pump_Off_4.bg="red"
-button_Pump_Off_5.bg="red"
-button_Pump_Off_6.bg="red"
-button_Pump_Off_7.bg="red"
-button_Pump_Off_8.bg="red"
-button_Pump_Off_1.text_size="16"
-button_Pump_Off_2.text_size="16"
-button_Pump_Off_3.text_size="16"
-button_Pump_Off_4.text_size="16"
-button_Pump_Off_5.text_size="16"
-button_Pump_Off_6.text_size="16"
-button_Pump_Off_7.text_size="16"
-button_Pump_Off_8.text_size="16"
-
-message = Text(app, text="", size=15) #vertical spacing
-
-pump_all_margin_left_box = Box(window_control_panel, layout="auto", width="200", align="left")
-pump_all_margin_right_box = Box(window_control_panel, layout="auto", width="200", align="right")
-pump_all_buttons_box = Box(window_control_panel, layout="auto", width="fill", align="top")
-
-button_all_forward = PushButton(pump_all_buttons_box, command=all_pumps_forward, align="top", width="fill", height="2", text="ALL FORWARD")
-button_all_reverse = PushButton(pump_all_buttons_box, command=all_pumps_reverse, align="top", width="fill", height="2", text="ALL REVERSE")
-button_all_off = PushButton(pump_all_buttons_box, command=all_pumps_off, align="top", width="fill", height="2", text="ALL OFF")
-button_exit = PushButton(pump_all_buttons_box, command=enter_main_panel, align="top", width="fill", height="2", text="EXIT")
-
-button_all_forward.text_color="white"
-button_all_reverse.text_color="white"
-button_all_off.text_color="white"
-button_all_forward.text_size="14"
-button_all_reverse.text_size="14"
-button_all_off.text_size="14"
-button_exit.text_size="14"
-button_all_forward.bg="#009900" #green
-button_all_reverse.bg="#0099ff" #blue
-button_all_off.bg="red"
-button_exit.bg="#808080" #grey
-
-app.display()
\ No newline at end of file
+#############################
+# Tweak drink screen layout
+#############################
+# A row per pump (name, slider, amount) - enter_tweak_panel hides the rows the drink doesn't use
+def build_tweak_panel():
+    global window_tweak_panel, tweak_title, tweak_rows, tweak_labels, tweak_sliders, tweak_amounts, tweak_size, tweak_estimate_text
+    window_tweak_panel = Window(app, title="iDrink Tweak drink", bg="white", height="600", width="1024")
+    window_tweak_panel.set_full_screen()
+    window_tweak_panel.hide()
+
+    # set screen left and right margins
+    tweak_left_margin_box = Box(window_tweak_panel, layout="auto", width=45, height="fill", align="left")
+    tweak_right_margin_box = Box(window_tweak_panel, layout="auto", width=45, height="fill", align="right")
+
+    message = Text(window_tweak_panel, text="", size=10) # vertical spacing
+    tweak_title = Text(window_tweak_panel, text="", size=30)
+
+    tweak_rows = []
+    tweak_labels = []
+    tweak_sliders = []
+    tweak_amounts = []
+    for x in range(PUMP_COUNT):
+        row = Box(window_tweak_panel, layout="auto", width="fill", align="top")
+        tweak_labels.append(Text(row, text="", size=16, width=15, align="left"))
+        tweak_sliders.append(Slider(row, start=0, end=TWEAK_MAX, command=tweak_changed, width=600, align="left"))
+        tweak_amounts.append(Text(row, text="", size=16, width=8, align="left"))
+        tweak_rows.append(row)
+
+    size_box = Box(window_tweak_panel, layout="auto", width="fill", align="top")
+    message = Text(size_box, text="Size %", size=16, width=15, align="left")
+    tweak_size = Slider(size_box, start=50, end=200, command=tweak_changed, width=600, align="left")
+    tweak_estimate_text = Text(window_tweak_panel, text="", size=20, color="blue")
+
+    tweak_buttons_box = Box(window_tweak_panel, layout="auto", width="fill", align="bottom")
+    button_tweak_pour = PushButton(tweak_buttons_box, command=pour_tweaked_drink, align="left", width="15", height="2", text="Pour")
+    button_tweak_cancel = PushButton(tweak_buttons_box, command=enter_main_panel, align="left", width="15", height="2", text="Cancel")
+    button_tweak_pour.bg="#009900" #green
+    button_tweak_pour.text_color="white"
+    button_tweak_cancel.bg="#cccccc" #grey
+
+    app.repeat(TWEAK_REFRESH_MS, refresh_tweak_estimate)
+
+def build_queue_panel():
+    global window_queue_panel, queue_orders_list, queue_panel_text
+    window_queue_panel = Window(app, title="iDrink Queue", bg="white", height="600", width="1024")
+    window_queue_panel.set_full_screen()
+    window_queue_panel.hide()
+
+    # set screen left and right margins
+    queue_left_margin_box = Box(window_queue_panel, layout="auto", width=45, height="fill", align="left")
+    queue_right_margin_box = Box(window_queue_panel, layout="auto", width=45, height="fill", align="right")
+
+    message = Text(window_queue_panel, text="", size=10) # vertical spacing
+    message = Text(window_queue_panel, text="Waiting orders", size=30)
+    queue_panel_text = Text(window_queue_panel, text="", size=20, color="blue")
+
+    queue_buttons_box = Box(window_queue_panel, layout="auto", width="fill", align="bottom")
+    button_queue_cancel = PushButton(queue_buttons_box, command=cancel_selected_order, align="left", width="15", height="2", text="Cancel Order")
+    button_queue_last = PushButton(queue_buttons_box, command=cancel_last_order, align="left", width="15", height="2", text="Cancel Last")
+    button_queue_back = PushButton(queue_buttons_box, command=enter_main_panel, align="left", width="15", height="2", text="Back")
+    button_queue_cancel.bg="#cc0000" #red
+    button_queue_cancel.text_color="white"
+    button_queue_last.bg="#cccccc" #grey
+    button_queue_back.bg="#cccccc" #grey
+
+    queue_orders_list = ListBox(window_queue_panel, width="fill", height="fill", scrollbar=True, align="top")
+    queue_orders_list.bg="white"
+    queue_orders_list.text_size = "24"
+    queue_orders_list.text_color = "blue"
+
+update_main_panel() #fill in the drink list and bottle levels
+startup_phase('Main screen')
+
+# Draw the pour engine's events on the UI thread
+subscribe_events(ui_event_listener)
+app.repeat(UI_REFRESH_MS, refresh_pour_display)
+
+# Start the watchdog, the inventory writer, the pour dispatchers (one per station) and the pour log writer (workers for the life of the app)
+# (a simulation leaves the real bottle levels alone)
+threading.Thread(target=watchdog_thread, daemon=True).start()  #first, before any pump can go on
+
+if not SIMULATING:
+    inventory_thread = threading.Thread(target=inventory_writer, daemon=True)
+    inventory_thread.start()
+
+for station in stations:
+    threading.Thread(target=pour_dispatcher, args=(station,), daemon=True).start()
+
+if pour_log_path is not None:
+    threading.Thread(target=pour_log_writer, args=(pour_log_path,), daemon=True).start()
+
+if args.api:  #local HTTP order API
+    threading.Thread(target=api_thread, args=(int(args.api),), daemon=True).start()
+
+# Watch Menu.json for edits (applied from the UI thread between pours)
+menu_watch_thread = threading.Thread(target=menu_watcher, daemon=True)
+menu_watch_thread.start()
+app.repeat(500, apply_menu_reload)
+
+if SIMULATING:  #replay the scripted orders, report, and quit
+    sim_orders = load_sim_orders(args.simulate)
+    sim_start = time.monotonic()
+    sim_cpu_start = time.process_time()
+    threading.Thread(target=simulator_feed, args=(sim_orders,), daemon=True).start()
+
+app.after(0, print_startup_times)  #runs once the main screen is up
+app.display()
+
+if inventory_dirty.is_set() and not SIMULATING:  #save the last pours' bottle levels
+    save_inventory()
+if pour_log_path is not None:  #and write the pours still waiting for the log writer
+    flush_pour_log(pour_log_path)
+
+if SIMULATING:
+    print_sim_report(sim_orders, time.monotonic() - sim_start, time.process_time() - sim_cpu_start)
\ No newline at end of file
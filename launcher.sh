@@ -4,6 +4,11 @@
 
 cd /
 cd home/pi/iDrink
-sleep 10s
+# wait for the desktop's X display to come up (at most 10s) rather than always sleeping 10s
+i=0
+while [ ! -e /tmp/.X11-unix/X0 ] && [ $i -lt 20 ]; do
+  sleep 0.5
+  i=$((i+1))
+done
 sudo python3 iDrink-RPi.py
 cd /